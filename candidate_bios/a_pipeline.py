@@ -10,12 +10,15 @@ and exporting the information into an output CSV file.
 """
 
 # Imports
-from b_search import search, searchRow
-from c_retrieval import retrieve
-from d_extraction import extract
+from b_search import orderRead, randomRead, rowRead, searchCSV, sourceData
+from c_retrieval import bioData, chatPrompt, retrieveCSV, scrapeWorkers
+import concurrent.futures
+from d_extraction import extractCSV, feedOutputs
 import glob
-import os
 import pandas as pd
+from pathlib import Path
+import queue
+import threading
 import time
 
 # Setup
@@ -88,14 +91,14 @@ def gatherData(n, r=4, read="random"):
     doneDelete = time.perf_counter()
     print(f"deleted old output files: {doneDelete - start} seconds")
 
-    # starts data search
-    search(n, r, read)
+    # reads candidate source data
+    if read == "random":
+        reps = randomRead(sourceData, n)  # chooses candidates randomly
+    else:
+        reps = orderRead(sourceData, n)  # chooses candidates in order
 
-    # starts data retrieval
-    retrieve()
-
-    # starts data extraction
-    extractions = extract()
+    # runs the data search, retrieval, and extraction phases concurrently
+    extractions = pipeline(reps, r)
 
     end = time.perf_counter()
     print(f"pipeline: {end - start} seconds")
@@ -132,20 +135,202 @@ def gatherRow(r=4, rows=[126073, 0, 27, 44, 46]):
     doneDelete = time.perf_counter()
     print(f"deleted old output files: {doneDelete - start} seconds")
 
-    # starts data search
-    searchRow(r, rows)
-
-    # starts data retrieval
-    retrieve()
+    # reads candidate source data for specified rows
+    reps = rowRead(sourceData, rows)
 
-    # starts data extraction
-    extractions = extract()
+    # runs the data search, retrieval, and extraction phases concurrently
+    extractions = pipeline(reps, r)
 
     end = time.perf_counter()
     print(f"pipeline: {end - start} seconds")
     return extractions
 
 
+def pipeline(reps, r=4, timeout=200):
+    """
+    Description
+        - Runs the data search, retrieval, and extraction phases concurrently.
+        Each candidate is scraped as soon as its Google Search finishes, and its
+        ChatGPT prompt is summarized as soon as it is created, so the runtime of
+        the pipeline is bounded by the slowest phase instead of the sum of the
+        phases. The intermediate results are still output to b1_searches.csv,
+        c1_retrievals.csv, and c2_scrapingTimeouts.csv.
+    Parameters
+        - reps: an array containing the relevant candidate information for each
+        candidate as the elements in the array. This is exactly the output of
+        randomRead, orderRead, or rowRead, depending on how the candidates were
+        chosen.
+        - r: an integer that specifies the number of Google API search results
+        to use during the gathering process. 1 <= r <= 4, and r is set to 4 by
+        default.
+        - timeout: the number of seconds a candidate may spend being scraped
+        before it is recorded as a timeout in c2_scrapingTimeouts.csv. timeout
+        is set to 200 by default.
+    Return
+        - A dataframe containing each candidate’s full name, state, min year,
+        candid, college major, undergraduate institution, highest degree, work
+        history, sources, and ChatGPT confidence. This dataframe is also output
+        to d1_extractions.csv.
+    """
+
+    startPipeline = time.perf_counter()
+
+    searchQueue = queue.Queue()  # searched candidates waiting to be scraped
+    promptQueue = queue.Queue()  # scraping futures waiting to be summarized
+
+    def searchPhase():
+        try:
+            searchCSV(reps, r, results=searchQueue)
+        except Exception as exc:
+            print(f"pipeline - searchCSV generated an exception: {exc}")
+            with open("errors.txt", "a") as f:
+                f.write(f"\n\npipeline - searchCSV generated an exception: {exc}")
+        finally:
+            searchQueue.put(None)  # signals the end of the data search phase
+
+    # each candidate is settled exactly once, either by its scraping finishing
+    # or by its deadline passing, whichever comes first
+    timeouts = []  # candidates whose scraping timed out
+    settled = set()
+    settledCondition = threading.Condition()
+
+    def settle(cand, future=None):
+        with settledCondition:
+            if id(cand) in settled:
+                return
+            settled.add(id(cand))
+            if future is not None:
+                promptQueue.put(future)
+            else:
+                timeouts.append(candidateInfo(cand))
+            settledCondition.notify_all()
+        if future is None:
+            print(f"{cand.candid} pipeline - bioData timed out")
+            with open("errors.txt", "a") as f:
+                f.write(
+                    f"\n\n{cand.candid} pipeline - bioData generated an exception: "
+                    "TimeoutError"
+                )
+
+    def retrieveWithDeadline(cand):
+        timer = threading.Timer(timeout, settle, (cand,))
+        timer.daemon = True
+        timer.start()  # starts the deadline once the candidate is being scraped
+        try:
+            return retrieveCandidate(cand)
+        finally:
+            timer.cancel()
+
+    def retrievePhase():
+        executor = concurrent.futures.ThreadPoolExecutor(scrapeWorkers)
+        try:
+            submitted = 0
+            while (cand := searchQueue.get()) is not None:
+                future = executor.submit(retrieveWithDeadline, cand)
+                future.add_done_callback(
+                    lambda future, cand=cand: settle(cand, future)
+                )
+                submitted += 1
+
+            # waits until every candidate has finished or timed out
+            with settledCondition:
+                settledCondition.wait_for(lambda: len(settled) == submitted)
+        except Exception as exc:
+            print(f"pipeline - retrieval generated an exception: {exc}")
+            with open("errors.txt", "a") as f:
+                f.write(f"\n\npipeline - retrieval generated an exception: {exc}")
+        finally:
+            # leaves timed out scrapes running instead of waiting on them
+            executor.shutdown(wait=False, cancel_futures=True)
+            promptQueue.put(None)  # signals the end of the data retrieval phase
+
+    # starts data search and data retrieval
+    searchThread = threading.Thread(target=searchPhase)
+    retrieveThread = threading.Thread(target=retrievePhase)
+    searchThread.start()
+    retrieveThread.start()
+
+    # summarizes prompts as they are created
+    prompts = []
+
+    def extractionPhase():
+        while (retrieval := promptQueue.get()) is not None:
+            try:
+                prompt = retrieval.result()
+            except Exception as exc:
+                print(f"pipeline - bioData generated an exception: {exc}")
+                with open("errors.txt", "a") as f:
+                    f.write(f"\n\npipeline - bioData generated an exception: {exc}")
+                continue
+            prompts.append(prompt)
+            yield {
+                "Prompt": prompt["Prompt"],
+                "Sources": prompt["Sources"],
+                "Full Name": prompt["Full"],
+                "Min Year": prompt["Min Year"],
+                "State": prompt["State"],
+                "Candid": prompt["Candid"],
+            }
+
+    # parses and writes each ChatGPT response as soon as it arrives
+    promptErrors = []
+    outputs = feedOutputs(extractionPhase(), "pipeline", promptErrors)
+    extractions = extractCSV(outputs, promptErrors, variant="normal")
+    searchThread.join()
+    retrieveThread.join()
+    doneFeed = time.perf_counter()
+    print(f"search, bioData, chatFeed, and extractCSV: {doneFeed - startPipeline} seconds")
+
+    # creates CSVs containing the ChatGPT prompts
+    retrieveCSV(prompts, timeouts)
+    doneCSV = time.perf_counter()
+    print(f"retrieveCSV: {doneCSV - doneFeed} seconds")
+
+    return extractions
+
+
+def retrieveCandidate(cand):
+    """
+    Description
+        - Scrapes the source URLs of a searched candidate and creates their
+        ChatGPT prompt.
+    Parameters
+        - cand: a Candidate whose sources are the top r URLs from the Google
+        Search. This is exactly an element put onto the results queue by
+        searchCSV.
+    Return
+        - A dictionary containing the ChatGPT prompt, source URLs, first name,
+        middle name, last name, full name, min year, state, and candid of the
+        candidate. This is exactly the output of chatPrompt().
+    """
+
+    return chatPrompt(bioData(candidateInfo(cand)))
+
+
+def candidateInfo(cand):
+    """
+    Description
+        - Converts a searched candidate into the dictionary format of a row of
+        b1_searches.csv.
+    Parameters
+        - cand: a Candidate put onto the results queue by searchCSV.
+    Return
+        - A dictionary containing the candidate’s source URLs, first name,
+        middle name, last name, full name, min year, state, and candid.
+    """
+
+    return {
+        "Sources": cand.sources,
+        "First": cand.first,
+        "Middle": cand.middle,
+        "Last": cand.last,
+        "Full": cand.full,
+        "Min Year": cand.min_year,
+        "State": cand.state,
+        "Candid": cand.candid,
+    }
+
+
 def deleteOutput(outputFiles):
     """
     Description
@@ -160,8 +345,7 @@ def deleteOutput(outputFiles):
     """
 
     for file in outputFiles:
-        if os.path.exists(file):
-            os.remove(file)
+        Path(file).unlink(missing_ok=True)  # skips files that do not exist
 
 
 def combineCSV(comboType, group):
@@ -198,9 +382,39 @@ def combineCSV(comboType, group):
     assert group in groups
 
     path = combinationPaths[comboType]
-    files = glob.glob(f"{path}/*.csv")
-    df = pd.concat(
-        [pd.read_csv(file, index_col=None, encoding="latin-1") for file in files]
+    outputPath = f"{path}/{comboType}{group}.csv"
+
+    # skips the combined CSV from a previous run so it is never read while
+    # it is being overwritten
+    files = [
+        file
+        for file in glob.glob(f"{path}/*.csv")
+        if Path(file).resolve() != Path(outputPath).resolve()
+    ]
+
+    # collects the union of every header so no file's columns are dropped
+    columns = list(
+        dict.fromkeys(
+            column
+            for file in files
+            for column in pd.read_csv(
+                file, index_col=None, encoding="latin-1", nrows=0
+            ).columns
+        )
     )
-    df.to_csv(f"{path}/{comboType}{group}.csv", escapechar="/")
-    print(f"\n{comboType}\n{df}")
+
+    # streams each CSV into the combined CSV in chunks to avoid holding every
+    # file in memory at once
+    header = True  # writes the header only once
+    rows = 0
+    with open(outputPath, "w", newline="", encoding="utf-8") as combined:
+        for file in files:
+            for chunk in pd.read_csv(
+                file, index_col=None, encoding="latin-1", chunksize=50000
+            ):
+                chunk.reindex(columns=columns).to_csv(
+                    combined, header=header, escapechar="/"
+                )
+                header = False
+                rows += len(chunk)
+    print(f"\n{comboType}\n{rows} rows")
@@ -11,23 +11,42 @@ b1_searches.csv.
 """
 
 # Imports
-from apiclient.discovery import build
+import concurrent.futures
+import contextlib
+import csv
+from dataclasses import dataclass, field, replace
 from dotenv import load_dotenv
+import functools
+import hashlib
+import numpy as np
 import os
 import pandas as pd
-import random
+import requests
+from requests.adapters import HTTPAdapter
+import shelve
 from tenacity import retry, stop_after_attempt, wait_random_exponential
+import threading
 import time
 
 # Setup
 sourceData = "./Data/ldata_R_unique.csv"  # adjust path if on SCC
+sourceTypes = {  # columns read from the source data and their compact dtypes
+    "first": "string",
+    "middle": "string",
+    "last": "string",
+    "suffix": "string",
+    "min_year": "Int32",
+    "sab": "category",
+    "candid": "Int64",
+}
 
 load_dotenv()
 google_api_key = os.environ.get("google_api_key")
 assert google_api_key
 engine = os.environ.get("engine")
 assert engine
-resource = build("customsearch", "v1", developerKey=google_api_key).cse()
+searchURL = "https://customsearch.googleapis.com/customsearch/v1"
+searchParams = {"key": google_api_key, "cx": engine, "lr": "lang_en", "cr": "us"}
 
 states = {
     "al": "Alabama",
@@ -84,9 +103,87 @@ states = {
 
 testRows = {"link test": 126073, "content test": 24526, "length test": 142634}
 
+searchWorkers = 8  # number of concurrent Google Search API calls
+googleQPS = 10  # Google Custom Search JSON API queries per second quota
+
+searchCache = "./searchCache"  # on-disk cache of Google Search API results
+searchCacheLock = threading.Lock()
+
+searchOutput = "b1_searches.csv"
+checkpointRows = 1000  # number of rows between forced writes of b1_searches.csv to disk
+
+
+@dataclass(frozen=True, slots=True)
+class Candidate:
+    """
+    Description
+        - Stores the relevant candidate information read from ldata_R_unique.csv
+        and the source URLs found for the candidate in the data search phase.
+    Attributes
+        - first, middle, last, full: strings representing the lowercase first
+        name, middle name, last name, and full name of the candidate.
+        - min_year, state, candid: strings representing the min year, full state
+        name, and candid of the candidate.
+        - row: a string representing the row of the candidate in
+        ldata_R_unique.csv.
+        - query: a string representing the Google Search query for the
+        candidate, which has the format {full name} {state}.
+        - sources: a string array containing the top r URLs from the Google
+        Search of the candidate. It is empty in the candidates read from
+        ldata_R_unique.csv, and filled in the copies returned by googleSearch().
+    """
+
+    first: str
+    middle: str
+    last: str
+    full: str
+    min_year: str
+    state: str
+    candid: str
+    row: str
+    query: str
+    sources: list[str] = field(default_factory=list)
+
+
+class RateLimiter:
+    """
+    Description
+        - Thread-safe rate limiter that spaces out the calls made inside of it
+        so that at most rate calls start per second across all threads.
+    Parameters
+        - rate: a number that specifies the maximum number of calls per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next = 0  # earliest time at which the next call may start
+
+    def __enter__(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+searchLimiter = RateLimiter(googleQPS)  # shared by all Google Search API calls
+
+# reuses connections to the Google Search API across calls and threads
+searchSession = requests.Session()
+searchSession.headers["Accept-Encoding"] = "gzip"
+searchSession.mount(
+    "https://", HTTPAdapter(pool_connections=1, pool_maxsize=searchWorkers)
+)
+
 
 # Data Search
-def search(n=1, r=4, read="random"):
+def search(n=1, r=4, read="random", forceRefresh=False, resume=False):
     """
     Description
         - Wrapper function used to run the data search phase.
@@ -100,10 +197,17 @@ def search(n=1, r=4, read="random"):
         If read is set to "random", then n unique random candidates are used,
         and if read = ‘order’, then the first n unique candidates in order are
         used. read is set to random by default.
+        - forceRefresh: a boolean that indicates whether to ignore the cached
+        Google Search API results and search every candidate again. forceRefresh
+        is set to False by default.
+        - resume: a boolean that indicates whether to continue an interrupted
+        data search. If resume is True, candidates already in b1_searches.csv
+        are skipped and the new results are appended to it. resume is set to
+        False by default.
     Return
-        - A dataframe containing each candidate’s Google Search results, first
+        - An array containing each candidate’s Google Search results, first
         name, middle name, last name, full name, min year, state, and candid.
-        This dataframe is also output to b1_searches.csv.
+        These candidates are also output to b1_searches.csv.
     """
 
     startSearch = time.perf_counter()
@@ -124,26 +228,17 @@ def search(n=1, r=4, read="random"):
     doneRead = time.perf_counter()
     print(f"{read}Read: {doneRead - startSearch} seconds")
 
-    # gets Google Search API URL results
-    urls = []
-    for index, rep in enumerate(reps):
-        urls += [googleSearch(rep, r)]
-        print(index, rep)
-        time.sleep(0.6)
+    # gets Google Search API URL results and writes them to b1_searches.csv
+    searches = searchCSV(reps, r, forceRefresh, resume)
     doneGoogle = time.perf_counter()
     print(f"googleSearch: {doneGoogle - doneRead} seconds")
 
-    # creates CSV containing Google URLs and other relevant candidate info
-    searches = searchCSV(urls)
-    doneSearchCSV = time.perf_counter()
-    print(f"searchCSV: {doneSearchCSV - doneGoogle} seconds")
-
     doneSearch = time.perf_counter()
     print(f"data search: {doneSearch - startSearch} seconds")
     return searches
 
 
-def searchRow(r=4, rows=[126073]):
+def searchRow(r=4, rows=[126073], forceRefresh=False, resume=False):
     """
     Description
         - Wrapper function used to run the data search phase on specified candidates.
@@ -156,10 +251,17 @@ def searchRow(r=4, rows=[126073]):
         should be equal to the row number for that candidate in
         ldata_R_unique.csv - 2 in order to account for the indexing in pandas
         dataframes.
+        - forceRefresh: a boolean that indicates whether to ignore the cached
+        Google Search API results and search every candidate again. forceRefresh
+        is set to False by default.
+        - resume: a boolean that indicates whether to continue an interrupted
+        data search. If resume is True, candidates already in b1_searches.csv
+        are skipped and the new results are appended to it. resume is set to
+        False by default.
     Return
-        - A dataframe containing each candidate's Google Search results, first
+        - An array containing each candidate's Google Search results, first
         name, middle name, last name, full name, min year, state, and candid.
-        This dataframe is also output to b1_searches.csv.
+        These candidates are also output to b1_searches.csv.
     """
 
     startSearch = time.perf_counter()
@@ -172,19 +274,11 @@ def searchRow(r=4, rows=[126073]):
     doneRead = time.perf_counter()
     print(f"rowRead: {doneRead - startSearch} seconds")
 
-    # gets Google Search API URL results
-    urls = []
-    for rep in reps:
-        urls.append(googleSearch(rep, r))
-        time.sleep(0.25)
+    # gets Google Search API URL results and writes them to b1_searches.csv
+    searches = searchCSV(reps, r, forceRefresh, resume)
     doneGoogle = time.perf_counter()
     print(f"googleSearch: {doneGoogle - doneRead} seconds")
 
-    # creates CSV containing ChatGPT prompts and other relevant candidate info
-    searches = searchCSV(urls)
-    doneSearchCSV = time.perf_counter()
-    print(f"searchCSV: {doneSearchCSV - doneGoogle} seconds")
-
     doneSearch = time.perf_counter()
     print(f"data search: {doneSearch - startSearch} seconds")
     return searches
@@ -204,41 +298,25 @@ def randomRead(file, n):
     Return
         - An array containing the relevant candidate information for each
         candidate as the elements in the array. Each element in the array is a
-        dictionary containing the full name delimited by quotes, state, first name,
-        last name, full name, and candid for the chosen candidate.
+        Candidate containing the first name, middle name, last name, full name,
+        min year, state, candid, and row of the chosen candidate.
     """
 
     # verifies parameters
     assert n > 0
 
-    df = pd.read_csv(file, index_col=None, encoding="latin-1")
-    df["sab"] = df["sab"].str.strip().replace(states)
-    alreadyRead = {}  # stores processed candidates
+    columns = sourceColumns(file)
+    alreadyRead = set()  # stores processed candidate names
     reps = []  # stores candidate info
 
-    i = 0
-    while i < n:
-        row = random.randint(0, len(df) - 1)  # randomly chooses candidate
-        name = [
-            str(df["first"][row]),
-            str(df["middle"][row]),
-            str(df["last"][row]),
-            str(df["suffix"][row]),
-        ]
-        candidate = {
-            "First": name[0].lower(),
-            "Middle": name[1].lower(),
-            "Last": name[2].lower(),
-            "Full": " ".join(part for part in name if part != "nan").lower(),
-            "Min Year": str(df["min_year"][row]),
-            "State": df["sab"][row],
-            "Candid": str(df["candid"][row]),
-            "Row": str(row),
-        }
-        if candidate["Full"] not in alreadyRead:  # verifies candidate is unique
-            reps.append(candidate)
-            alreadyRead[candidate["Full"]] = 1
-            i += 1
+    # visits the candidates in a random order without repeats
+    for row in np.random.default_rng().permutation(len(columns["first"])):
+        if len(reps) == n:
+            break
+        full = columns["full"][row]
+        if full not in alreadyRead:  # verifies candidate is unique
+            reps.append(candidateInfo(columns, row))
+            alreadyRead.add(full)
     return reps
 
 
@@ -256,38 +334,18 @@ def orderRead(file, n):
     Return
         - An array containing the relevant candidate information for each
         candidate as the elements in the array. Each element in the array is a
-        dictionary containing the full name delimited by quotes, state, first name,
-        last name, full name, and candid for the chosen candidate.
+        Candidate containing the first name, middle name, last name, full name,
+        min year, state, candid, and row of the chosen candidate.
     """
 
     # verifies parameters
     assert n > 0
 
-    df = pd.read_csv(file, index_col=None, encoding="latin-1")
-    df["sab"] = df["sab"].str.strip().replace(states)
-    reps = []  # stores candidate info
+    columns = sourceColumns(file)
+    start = 0  # set to desired starting row in source data
 
-    row = 0  # set to desired starting row in source data
-    while row < n:  # hardcode n to len(df) to read entire CSV
-        name = [
-            str(df["first"][row]),
-            str(df["middle"][row]),
-            str(df["last"][row]),
-            str(df["suffix"][row]),
-        ]
-        candidate = {
-            "First": name[0].lower(),
-            "Middle": name[1].lower(),
-            "Last": name[2].lower(),
-            "Full": " ".join(part for part in name if part != "nan").lower(),
-            "Min Year": str(df["min_year"][row]),
-            "State": df["sab"][row],
-            "Candid": str(df["candid"][row]),
-            "Row": str(row),
-        }
-        reps.append(candidate)
-        row += 1
-    return reps
+    # hardcode n to len(columns["first"]) to read entire CSV
+    return [candidateInfo(columns, row) for row in range(start, n)]
 
 
 def rowRead(file, rows):
@@ -305,33 +363,131 @@ def rowRead(file, rows):
     Return
         - An array containing the relevant candidate information for each
         candidate as the elements in the array. Each element in the array is a
-        dictionary containing the full name delimited by quotes, state, first name,
-        last name, full name, and candid for the chosen candidate.
+        Candidate containing the first name, middle name, last name, full name,
+        min year, state, candid, and row of the chosen candidate.
     """
 
-    df = pd.read_csv(file, index_col=None, encoding="latin-1")
-    df["sab"] = df["sab"].str.strip().replace(states)
-    reps = []  # stores candidate info
+    columns = sourceColumns(file)
 
-    for row in rows:  # iterates through all specified candidates
-        name = [
-            str(df["first"][row]),
-            str(df["middle"][row]),
-            str(df["last"][row]),
-            str(df["suffix"][row]),
-        ]
-        candidate = {
-            "First": name[0].lower(),
-            "Middle": name[1].lower(),
-            "Last": name[2].lower(),
-            "Full": " ".join(part for part in name if part != "nan").lower(),
-            "Min Year": str(df["min_year"][row]),
-            "State": df["sab"][row],
-            "Candid": str(df["candid"][row]),
-            "Row": str(row),
-        }
-        reps.append(candidate)
-    return reps
+    # iterates through all specified candidates
+    return [candidateInfo(columns, row) for row in rows]
+
+
+@functools.lru_cache(maxsize=1)
+def sourceColumns(file):
+    """
+    Description
+        - Reads ldata_R_unique.csv and extracts the columns used to describe
+        each candidate as arrays of strings, so that candidates can be built
+        without indexing the dataframe row by row. The result is cached, so the
+        source data is only parsed once per session. A Parquet copy of the
+        source data is also saved next to it, which is read instead of the CSV
+        in later sessions as long as the CSV has not been modified.
+    Parameters
+        - file: a string representing the file path to ldata_R_unique. The
+        global variable sourceData is always passed in as file.
+    Return
+        - A dictionary whose keys are the first, middle, last, suffix, min_year,
+        sab, and candid column names of ldata_R_unique.csv, and whose values
+        are string arrays containing every row of that column. The sab column
+        contains the full state names. The dictionary also contains the full
+        name of every candidate under the key full.
+    """
+
+    # reads the Parquet copy of the source data if it is up to date
+    parquetFile = f"{os.path.splitext(file)[0]}.parquet"
+    parquetCurrent = os.path.exists(parquetFile) and (
+        os.path.getmtime(parquetFile) >= os.path.getmtime(file)
+    )
+    if parquetCurrent:
+        df = pd.read_parquet(parquetFile, columns=list(sourceTypes))
+    else:
+        df = pd.read_csv(
+            file,
+            index_col=None,
+            usecols=list(sourceTypes),
+            dtype=sourceTypes,
+            encoding="latin-1",
+            engine="pyarrow",
+        )
+        try:
+            df.to_parquet(parquetFile, index=False)
+        except Exception as exc:
+            print(f"sourceColumns - could not save {parquetFile}: {exc}")
+
+    # converts state abbreviations to state names once per distinct abbreviation
+    sab = df["sab"].astype("category")
+    stateNames = {
+        abbreviation: states.get(abbreviation.strip(), abbreviation.strip())
+        for abbreviation in sab.cat.categories
+    }
+    df["sab"] = sab.map(stateNames)
+
+    # converts the columns to strings, writing missing values as "nan"
+    columns = {
+        column: df[column].astype("string").fillna("nan").to_numpy(dtype=object)
+        for column in sourceTypes
+    }
+    columns["full"] = fullNames(
+        columns["first"], columns["middle"], columns["last"], columns["suffix"]
+    )
+
+    return columns
+
+
+def candidateInfo(columns, row):
+    """
+    Description
+        - Creates the Candidate describing a single candidate from the columns
+        of ldata_R_unique.csv.
+    Parameters
+        - columns: a dictionary of string arrays containing the columns of
+        ldata_R_unique.csv. This is exactly the output of sourceColumns().
+        - row: an integer that specifies the row of the candidate.
+    Return
+        - A Candidate containing the first name, middle name, last name, full
+        name, min year, state, candid, row, and Google Search query of the
+        candidate.
+    """
+
+    full = columns["full"][row]
+    state = columns["sab"][row]
+    return Candidate(
+        first=columns["first"][row].lower(),
+        middle=columns["middle"][row].lower(),
+        last=columns["last"][row].lower(),
+        full=full,
+        min_year=columns["min_year"][row],
+        state=state,
+        candid=columns["candid"][row],
+        row=str(row),
+        query=f"{full.title()} {state}",
+    )
+
+
+def fullNames(first, middle, last, suffix):
+    """
+    Description
+        - Creates the lowercase full name of every candidate by joining the
+        parts of their name that are present.
+    Parameters
+        - first: a string array containing the first name of every candidate.
+        - middle: a string array containing the middle name of every candidate.
+        - last: a string array containing the last name of every candidate.
+        - suffix: a string array containing the suffix of every candidate.
+    Return
+        - A string array containing the full name of every candidate.
+    """
+
+    # joins the name parts column by column, skipping the missing parts
+    full = np.asarray(first, dtype=str)
+    full = np.where(full == "nan", "", full)
+    for part in (middle, last, suffix):
+        part = np.asarray(part, dtype=str)
+        joined = np.where(full == "", part, np.char.add(np.char.add(full, " "), part))
+        full = np.where(part == "nan", full, joined)
+
+    return np.char.lower(full).astype(object)
 
 
 @retry(
@@ -339,96 +495,174 @@ def rowRead(file, rows):
     stop=stop_after_attempt(6),
     before_sleep=lambda _: print("retrying googleSearch"),
 )
-def googleSearch(rep, r=4):
+def googleSearch(rep, r=4, forceRefresh=False, cache=None):
     """
     Description
         - Uses the Google Custom Search JSON API and a Google Custom Search Engine
         to gather the top URLs from the Google Search of each candidate.
     Parameters
-        - rep: a dictionary containing the full name delimited by quotes, state, first
-        name, last name, full name, and candid of a candidate. This is exactly
-        an element from the output of randomRead, orderRead, or rowRead, depending
-        on how the candidates were chosen.
+        - rep: a Candidate containing the first name, middle name, last name,
+        full name, min year, state, candid, and row of a candidate. This is
+        exactly an element from the output of randomRead, orderRead, or rowRead,
+        depending on how the candidates were chosen.
         - r: an integer that specifies the number of Google API search results
         to use during the gathering process. 1 <= r <= 4, and r is set to 4 by
         default.
+        - forceRefresh: a boolean that indicates whether to skip the cached
+        results and call the API again. forceRefresh is set to False by default.
+        - cache: an optional shelf of the searchCache, opened once by the caller
+        and shared by all search threads. If cache is None, the searchCache is
+        opened for each lookup. cache is set to None by default.
     Return
-        - A dictionary containing the top r URLs from the Google Search, first name,
-        middle name, last name, full name, min year, state, and candid of a
-        candidate as keys. The value containing the top r URLs is a string array.
+        - A copy of the Candidate with its sources set to the top r URLs from the
+        Google Search.
     """
 
     # verifies parameters
     assert 1 <= r <= 4
 
+    # uses the cached Google Search API results if the candidate was already searched
+    key = hashlib.sha1(f"{rep.full}|{rep.state}|{r}".encode()).hexdigest()
+    if not forceRefresh:
+        with searchCacheLock, openSearchCache(cache) as shelf:
+            sources = shelf.get(key)
+        if sources is not None:
+            return replace(rep, sources=sources)
+
     # searches Google using query of format {full name} {state}
-    query = f"{rep['Full'].title()} {rep['State']}"
-    results = resource.list(q=query, cx=engine, lr="lang_en", cr="us", num=r).execute()
-    rep["Sources"] = []
+    with searchLimiter:  # keeps the concurrent searches under the API quota
+        response = searchSession.get(
+            searchURL, params={**searchParams, "q": rep.query, "num": r}, timeout=30
+        )
+    response.raise_for_status()  # lets retry back off on quota errors
+    results = response.json()
 
     # processes Google Search API results
-    try:
-        for item in results["items"]:
-            if "link" in item:
-                rep["Sources"].append(item["link"])
-    except:
-        rep["Sources"] = [""]
-    return rep
+    if "items" in results:
+        sources = [item["link"] for item in results["items"] if "link" in item]
+    else:
+        sources = [""]
+
+    # caches the Google Search API results
+    with searchCacheLock, openSearchCache(cache) as shelf:
+        shelf[key] = sources
+    return replace(rep, sources=sources)
 
 
-def searchCSV(urls):
+def openSearchCache(cache=None):
     """
     Description
-        - Processes the data gathered in the data search phrase and converts it
-        into a pandas dataframe and CSV file.
+        - Gets a context manager for the searchCache shelf used by googleSearch().
     Parameters
-        - urls: an array containing the relevant candidate information for
-        each candidate as the elements in the array. Each element is itself a
-        dictionary containing the top r URLs from the Google Search, first name,
-        middle name, last name, full name, min year, state, and candid of the
-        candidate as keys. The value containing the top r URLs is a string array.
+        - cache: an already open shelf of the searchCache, or None.
     Return
-        - A dataframe containing each candidate’s Google Search results, first
-        name, middle name, last name, full name, min year, state, and candid.
-        This dataframe is also output to b1_searches.csv.
+        - A context manager that yields cache without closing it if cache is
+        given, or that opens and closes the searchCache otherwise.
+    """
+
+    if cache is not None:
+        return contextlib.nullcontext(cache)
+    return shelve.open(searchCache)
+
+
+def searchCSV(reps, r=4, forceRefresh=False, resume=False, results=None):
     """
+    Description
+        - Searches the candidates with the Google Search API using multithreading
+        and writes each result to b1_searches.csv as soon as it arrives, so that
+        completed searches are not lost if the data search phase is interrupted.
+    Parameters
+        - reps: an array containing the relevant candidate information for each
+        candidate as the elements in the array. This is exactly the output of
+        randomRead, orderRead, or rowRead, depending on how the candidates were
+        chosen.
+        - r: an integer that specifies the number of Google API search results
+        to use during the gathering process. 1 <= r <= 4, and r is set to 4 by
+        default.
+        - forceRefresh: a boolean that indicates whether to ignore the cached
+        Google Search API results and search every candidate again. forceRefresh
+        is set to False by default.
+        - resume: a boolean that indicates whether to continue an interrupted
+        data search. If resume is True, candidates already in b1_searches.csv
+        are skipped and the new results are appended to it. Otherwise,
+        b1_searches.csv is overwritten. resume is set to False by default.
+        - results: an optional queue.Queue onto which each searched candidate is
+        also put as soon as its search finishes, so that later phases can start
+        on it right away. results is set to None by default.
+    Return
+        - An array containing each newly searched candidate’s Google Search
+        results, first name, middle name, last name, full name, min year, state,
+        and candid, in the order of reps. These candidates are also output to
+        b1_searches.csv in the order in which their searches finished.
+    """
+
+    columns = [
+        "Sources",
+        "First",
+        "Middle",
+        "Last",
+        "Full",
+        "Min Year",
+        "State",
+        "Candid",
+    ]
+
+    # skips candidates that were already written to b1_searches.csv
+    resume = resume and os.path.exists(searchOutput)
+    written = 0
+    if resume:
+        with open(searchOutput, "rb+") as f:
+            end = 0
+            for line in f:
+                if line.endswith(b"\n"):
+                    end += len(line)
+            f.truncate(end)  # removes a partially written last row
+        searched = pd.read_csv(searchOutput, usecols=["Candid"])["Candid"].astype(str)
+        written = len(searched)
+        searched = set(searched)
+        reps = [rep for rep in reps if rep.candid not in searched]
 
     # creates CSV containing Google URLs and other relevant candidate info
-    rawData = {
-        "Sources": [],
-        "First": [],
-        "Middle": [],
-        "Last": [],
-        "Full": [],
-        "Min Year": [],
-        "State": [],
-        "Candid": [],
-    }
-    for cand in urls:
-        if len(cand) == 9:
-            try:
-                rawData["Sources"].append(cand["Sources"])
-                rawData["First"].append(cand["First"])
-                rawData["Middle"].append(cand["Middle"])
-                rawData["Last"].append(cand["Last"])
-                rawData["Full"].append(cand["Full"])
-                rawData["Min Year"].append(cand["Min Year"])
-                rawData["State"].append(cand["State"])
-                rawData["Candid"].append(cand["Candid"])
-            except:
-                continue
-    df = pd.DataFrame(
-        rawData,
-        columns=[
-            "Sources",
-            "First",
-            "Middle",
-            "Last",
-            "Full",
-            "Min Year",
-            "State",
-            "Candid",
-        ],
-    )
-    df.to_csv("b1_searches.csv")
-    return df
+    urls = [None] * len(reps)
+    with open(searchOutput, "a" if resume else "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if not resume:
+            # matches the index column written by pandas
+            writer.writerow([""] + columns)
+
+        # gets Google Search API URL results using multithreading, sharing one
+        # open searchCache between the threads
+        with shelve.open(searchCache) as cache, concurrent.futures.ThreadPoolExecutor(
+            max_workers=searchWorkers
+        ) as executor:
+            futures = {
+                executor.submit(googleSearch, rep, r, forceRefresh, cache): index
+                for index, rep in enumerate(reps)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                cand = future.result()
+                urls[index] = cand  # preserves the order of the candidates
+                print(index, cand)
+                writer.writerow(
+                    [
+                        written,
+                        cand.sources,
+                        cand.first,
+                        cand.middle,
+                        cand.last,
+                        cand.full,
+                        cand.min_year,
+                        cand.state,
+                        cand.candid,
+                    ]
+                )
+                written += 1
+                if results is not None:
+                    results.put(cand)
+
+                # checkpoints the results written so far to disk
+                if written % checkpointRows == 0:
+                    f.flush()
+                    os.fsync(f.fileno())
+    return urls
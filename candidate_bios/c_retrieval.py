@@ -13,24 +13,103 @@ also be passed in as the searchData to retry scraping them.
 """
 
 # Imports
-from bs4 import BeautifulSoup
+import atexit
+import collections
 import concurrent.futures
-import io
+import csv
+import httpx
+import multiprocessing
+import os
 import pandas as pd
-import PyPDF2
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pypdfium2 as pdfium
 import re
-from requests_html import HTMLSession
+from selectolax.parser import HTMLParser
+import threading
 import time
-import urllib.request
+from urllib.parse import urldefrag, urlparse
 
 # Setup
-timeoutCandidates = []
-
 searchData = "./b1_searches.csv"  # set accordingly to relevant searches
+scrapeWorkers = 32  # scraping is network bound, so oversubscribe the cpus
+pdfMaxBytes = 10 * 1024 * 1024  # skips pdfs larger than 10 MB
+pdfWorkers = os.cpu_count()  # pdf text extraction is cpu bound
+pdfTimeout = 60  # seconds a worker may spend extracting the text of one pdf
+pageMaxBytes = 20 * 1024 * 1024  # skips any page larger than 20 MB
+pageTypes = ("text/html", "application/xhtml+xml", "application/pdf")
+grabberWindow = 8192  # characters scanned at a time for the words after a phrase
+newlines = re.compile(r"\s*\n\s*")
+
+# reuses connections to the same hosts across all scraped source URLs, and
+# multiplexes concurrent requests to hosts that support HTTP/2 on one connection
+scrapeClient = httpx.Client(
+    follow_redirects=True,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        retries=2,  # retries failed connections
+    ),
+)
+
+# bounds the number of concurrent requests made to any single host
+hostLimit = 6
+hostSlots = collections.defaultdict(lambda: threading.Semaphore(hostLimit))
+hostSlotsLock = threading.Lock()
+
+# reuses the text of recently scraped URLs that are shared between candidates
+pageCacheSize = 512
+pageCache = collections.OrderedDict()
+pageCacheLock = threading.Lock()
+
+# extracts pdf text in separate processes so it does not hold the GIL while the
+# scraping threads are downloading, started on the first pdf from a clean
+# process instead of forking the threaded scraper
+pdfProcesses = None
+pdfProcessesLock = threading.Lock()
+
+# buffers writes to the output files instead of issuing one syscall per 8 KB
+outputBuffer = 1 << 20
+errorLog = None
+errorLogLock = threading.Lock()
+
+# ChatGPT prompt for each candidate, filled in by chatPrompt()
+promptTemplate = (
+    "Extract ONLY the College Major, Undergraduate Institution, Highest Degree "
+    "        and Institution, and Work History of {full}, a state representative "
+    "        candidate from {state}, from the following text: {text}. If any desired "
+    "        information is not present in the given text, write N/A instead. Determine "
+    "        your confidence that the information you previously extracted correctly "
+    "        describes {full}, a {year} state representative candidate from "
+    "        {state}, on a scale of 1 to 100. Display the college major, undergraduate "
+    "        institution, highest degree and institution, work history, and your confidence "
+    "        level as 5 elements of a JSON object. {text}"
+).format
+
+searchColumns = [
+    "Sources",
+    "First",
+    "Middle",
+    "Last",
+    "Full",
+    "Min Year",
+    "State",
+    "Candid",
+]
+
+retrievalColumns = [
+    "ChatGPT Prompt",
+    "Sources",
+    "Full Name",
+    "Min Year",
+    "State",
+    "Candid",
+]
 
 
 # Data Retrieval
-def retrieve(searchData=searchData, timeout=200):
+def retrieve(searchData=searchData, timeout=200, engine="pandas", resume=False):
     """
     Description
         - Wrapper function used to run the data retrieval phase.
@@ -39,9 +118,15 @@ def retrieve(searchData=searchData, timeout=200):
         b1_searches.csv, which contains all of the information gathered in the
         data search phase. This can optionally be configured to another CSV
         of the proper format.
+        - engine: a string that specifies the library used to write
+        c2_scrapingTimeouts.csv. Can be either "pandas" or "pyarrow".
+        c1_retrievals.csv is always streamed row by row as candidates finish.
+        - resume: a boolean that specifies whether to keep the prompts already
+        in c1_retrievals.csv from an interrupted run and only scrape the
+        candidates that are missing from it.
     Return
         - A dataframe containing each candidate’s ChatGPT prompt, sources, full
-        name, min year, state, and candid. This dataframe is also output to
+        name, min year, state, and candid. This dataframe is read back from
         c1_retrievals.csv.
     """
 
@@ -49,117 +134,180 @@ def retrieve(searchData=searchData, timeout=200):
 
     # verifies parameters
     assert timeout > 0
+    assert engine in ["pandas", "pyarrow"]
 
     # processes search data
     try:
-        df = pd.read_csv(searchData, index_col=None, encoding="latin-1")
-        urls = [
-            {
-                "Sources": sourceParser(sources),
-                "First": first,
-                "Middle": middle,
-                "Last": last,
-                "Full": full,
-                "Min Year": min_year,
-                "State": state,
-                "Candid": candid,
-            }
-            for sources, first, middle, last, full, min_year, state, candid in zip(
-                df["Sources"],
-                df["First"],
-                df["Middle"],
-                df["Last"],
-                df["Full"],
-                df["Min Year"],
-                df["State"],
-                df["Candid"],
-            )
-        ]
-    except:
-        print("retrieve - searchData processing error")
+        table = pacsv.read_csv(
+            searchData,
+            read_options=pacsv.ReadOptions(encoding="latin-1"),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=searchColumns,
+                column_types={
+                    column: pa.int32() if column == "Min Year" else pa.string()
+                    for column in searchColumns
+                },  # keeps names such as "nan" as strings for bioData
+                strings_can_be_null=False,
+            ),
+        )
+        urls = table.to_pylist()
+        for url in urls:
+            url["Sources"] = sourceParser(url["Sources"])
+    except (OSError, ValueError, KeyError) as exc:
+        print(f"retrieve - searchData processing error: {exc}")
+        raise
+
+    # skips candidates whose prompts were written before the run was interrupted
+    done = retrievedCandids() if resume else set()
+    if done:
+        urls = [url for url in urls if url["Candid"] not in done]
+        print(f"resuming retrieval - {len(done)} candidates already retrieved")
 
     # splits candidate sources into batches of 100
-    try:
-        cands = splitCandidates(urls, 100)
-    except:
-        print("retrieve - splitCandidates error")
+    cands = splitCandidates(urls, 100)
 
     # scrapes candidate sources using batches of multithreading
     batchTimes = []
-    bios = []
+    timeouts = collections.deque()  # candidates whose scraping timed out
 
     # set firstBatch and lastBatch to desired batches to scrape
     firstBatch = 0
     lastBatch = 100
 
-    # scrapes candidate source URLs multithreading
-    for index, group in enumerate(cands[firstBatch:lastBatch]):
-        batchStart = time.perf_counter()
-        try:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = {executor.submit(bioData, link): link for link in group}
-                for future in futures:
-                    info = futures[future]
-                    try:
-                        result = future.result(timeout)
-                        bios.append(result)
-                    except concurrent.futures.TimeoutError:
-                        timeoutCandidates.append(info)
-                        print(f"{info} retrieve - bioData timed out")
-                        with open("errors.txt", "a") as f:
-                            f.write(
-                                f"\n\n{info} retrieve - bioData generated an exception: TimeoutError"
-                            )
-                        # raise KeyboardInterrupt
-                    except Exception as exc:
-                        print(
-                            f"{info} retrieve - bioData generated an exception: {exc}"
-                        )
-                        with open("errors.txt", "a") as f:
-                            f.write(
-                                f"\n\n{info} retrieve - bioData generated an exception: {exc}"
-                            )
-            batchDone = time.perf_counter()
-            batchTime = batchDone - batchStart
-            batchTimes.append(batchTime)
-            print(
-                f"\nfinished scraping group {index + 1} / {lastBatch - firstBatch} in {batchTime} seconds\n"
-            )
-        except:
-            print(f"retrieve - error scraping group {index + 1}")
-            batchTimes.append("error")
+    # scrapes candidate source URLs multithreading and writes each prompt as
+    # soon as its candidate finishes, instead of holding every prompt in memory
+    with open(
+        "c1_retrievals.csv",
+        "a" if done else "w",
+        buffering=outputBuffer,
+        encoding="utf-8",
+        newline="",
+    ) as f:
+        writer = csv.writer(f, escapechar="/")
+        if not done:
+            writer.writerow(retrievalColumns)
+        with concurrent.futures.ThreadPoolExecutor(scrapeWorkers) as executor:
+            for index, group in enumerate(cands[firstBatch:lastBatch]):
+                batchStart = time.perf_counter()
+                try:
+                    scrapeBatch(executor, group, timeout, writer, timeouts)
+                    f.flush()  # saves the prompts of each finished batch
+                    batchDone = time.perf_counter()
+                    batchTime = batchDone - batchStart
+                    batchTimes.append(batchTime)
+                    print(
+                        f"\nfinished scraping group {index + 1} / {lastBatch - firstBatch} in {batchTime} seconds\n"
+                    )
+                except Exception as exc:
+                    print(f"retrieve - error scraping group {index + 1}: {exc}")
+                    logError(f"\n\nretrieve - error scraping group {index + 1}: {exc}")
+                    batchTimes.append("error")
 
     doneBio = time.perf_counter()
-    print(f"bioData: {doneBio - startRetrieve} seconds")
+    print(f"bioData and chatPrompt: {doneBio - startRetrieve} seconds")
     print(f"batch times (seconds): {batchTimes}")
 
-    # creates ChatGPT prompts for each candidate using multithreading
-    prompts = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(chatPrompt, info): info for info in bios}
-        for future in concurrent.futures.as_completed(futures):
-            prompt = futures[future]
-            try:
-                prompts.append(future.result())
-            except Exception as exc:
-                print(f"{prompt} retrieve - chatPrompt generated an exception: {exc}")
-                with open("errors.txt", "a") as f:
-                    f.write(
-                        f"\n\n{prompt} retrieve - chatPrompt generated an exception: {exc}"
-                    )
-    donePrompt = time.perf_counter()
-    print(f"chatPrompt: {donePrompt - doneBio} seconds")
-
-    # creates CSV containing ChatGPT prompts and other relevant candidate info
-    retrievals = retrieveCSV(prompts)
+    # creates CSV containing candidates whose web scraping timed out
+    timeoutCSV(timeouts, engine)
+    retrievals = pd.read_csv(
+        "c1_retrievals.csv", index_col=None, encoding="utf-8", escapechar="/"
+    )
     doneRetrieveCSV = time.perf_counter()
-    print(f"retrieveCSV: {doneRetrieveCSV - donePrompt} seconds")
+    print(f"retrieveCSV: {doneRetrieveCSV - doneBio} seconds")
 
     doneRetrieve = time.perf_counter()
     print(f"data retrieval: {doneRetrieve - startRetrieve} seconds")
     return retrievals
 
 
+def scrapeBatch(executor, group, timeout, writer, timeouts):
+    """
+    Description
+        - Scrapes the source URLs of a batch of candidates and writes the ChatGPT
+        prompt of each candidate to c1_retrievals.csv as soon as it finishes.
+    Parameters
+        - executor: the concurrent.futures.ThreadPoolExecutor shared by all
+        batches of retrieve().
+        - group: an array whose elements are dictionaries containing each
+        candidate’s Google Search results, first name, middle name, last name,
+        full name, min year, state, and candid as keys.
+        - timeout: the number of seconds the batch may take before its
+        unfinished candidates are recorded as timeouts.
+        - writer: the csv.writer for c1_retrievals.csv.
+        - timeouts: a collections.deque that the candidates whose web scraping
+        timed out are appended to.
+    Return
+        - None. The prompts are written to c1_retrievals.csv.
+    """
+
+    futures = {executor.submit(bioData, link): link for link in group}
+    pending = set(futures)
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout):
+            pending.discard(future)
+            info = futures[future]
+            try:
+                bio = future.result()
+            except Exception as exc:
+                print(f"{info} retrieve - bioData generated an exception: {exc}")
+                logError(f"\n\n{info} retrieve - bioData generated an exception: {exc}")
+                continue
+
+            # creates the ChatGPT prompt for the candidate
+            try:
+                row = retrievalRow(chatPrompt(bio))
+            except Exception as exc:
+                print(f"{bio} retrieve - chatPrompt generated an exception: {exc}")
+                logError(
+                    f"\n\n{bio} retrieve - chatPrompt generated an exception: {exc}"
+                )
+                continue
+            if row:
+                writer.writerow(row)
+    except concurrent.futures.TimeoutError:
+        # candidates still unfinished when the batch deadline passes keep running
+        # in the shared executor, but are recorded as timeouts
+        for future in pending:
+            info = futures[future]
+            future.cancel()
+            timeouts.append(
+                dict(info)
+            )  # copies the candidate before bioData adds its prompt
+            print(f"{info} retrieve - bioData timed out")
+            logError(
+                f"\n\n{info} retrieve - bioData generated an exception: TimeoutError"
+            )
+
+
+def retrievedCandids():
+    """
+    Description
+        - Finds the candidates whose ChatGPT prompts are already stored in
+        c1_retrievals.csv, so that an interrupted retrieval can be resumed. A
+        last row that was cut off by the interruption is removed from the file.
+    Parameters
+        - None.
+    Return
+        - A set containing the candid of each candidate in c1_retrievals.csv as
+        a string. The set is empty if c1_retrievals.csv does not exist.
+    """
+
+    try:
+        with open("c1_retrievals.csv", "rb+") as f:
+            end = 0
+            for line in f:
+                if line.endswith(b"\n"):
+                    end += len(line)
+            f.truncate(end)  # removes a partially written last row
+    except FileNotFoundError:
+        return set()
+
+    with open("c1_retrievals.csv", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, escapechar="/")
+        next(reader, None)  # skips header
+        return {row[5] for row in reader}
+
+
 def splitCandidates(urls, groupSize):
     """
     Description
@@ -217,32 +365,15 @@ def bioData(link):
 
     # initializes utility variables for scraping
     summaries = []
+    names = [link[name] for name in ("Last", "First", "Middle") if link[name] != "nan"]
 
     # scrapes candidate source URLs
     for url in link["Sources"]:
         if url != "nan":  # verifies URL exists
             try:
                 s = time.perf_counter()
-                if ".pdf" in url:
-                    try:
-                        information = pdfReader(url).lower()  # handles PDFs
-                    except:
-                        print(f"pdfReader failed - {url}")
-                    f = time.perf_counter()
-                    print(f"pdfReader: {str(f - s)} seconds")
-                else:
-                    session = HTMLSession()
-                    r = session.get(url)
-                    soup = BeautifulSoup(
-                        r.html.raw_html, "html.parser"
-                    )  # obtains html text of page
-                    for tag in soup.find_all(
-                        ["script", "style"]
-                    ):  # removes all javascript and css from page
-                        tag.decompose()
-                    information = (
-                        " ".join(soup.stripped_strings).strip().lower()
-                    )  # removes html tags, leading and trailing whitespaces, and makes text lowercase
+                information = pageText(url, names)
+                summary = ""
 
                 # scrapes text after last name if present
                 if link["Last"] != "nan":
@@ -259,7 +390,8 @@ def bioData(link):
                 summaries.append(summary)
                 doneScraping = time.perf_counter()
                 print(f"web scraper: {str(doneScraping - s)} seconds")
-            except:
+            except (httpx.HTTPError, httpx.InvalidURL, OSError, ValueError) as exc:
+                print(f"bioData failed - {url}: {exc}")
                 continue
 
     link["Prompt"] = " ".join(summaries)
@@ -267,6 +399,92 @@ def bioData(link):
     return link
 
 
+def pageText(url, names=()):
+    """
+    Description
+        - Scrapes the plain text of a webpage or pdf, reusing the text of URLs
+        that were recently scraped for other candidates.
+    Parameters
+        - url: a string that represents the web URL of a webpage or pdf.
+        - names: an array containing the names of the candidate that are
+        searched for in the text. Webpages whose html does not contain any of
+        them are not parsed.
+    Return
+        - A lowercase string representing the plain text of the webpage or pdf.
+        The string is empty if the page is too large, is not a webpage or pdf,
+        is a webpage that does not mention the candidate, or is a pdf that
+        could not be read.
+    """
+
+    key = urldefrag(url).url
+    with pageCacheLock:
+        if key in pageCache:
+            pageCache.move_to_end(key)
+            return pageCache[key]
+
+    # checks the type and size of the page before downloading it
+    try:
+        with hostSlot(url):
+            head = scrapeClient.head(url, timeout=httpx.Timeout(10.0, connect=5.0))
+        head.raise_for_status()
+        contentType = head.headers.get("Content-Type", "").lower()
+        size = int(head.headers.get("Content-Length") or 0)
+    except (httpx.HTTPError, ValueError):
+        contentType, size = "", 0  # some servers reject HEAD, so falls back to GET
+
+    information = ""
+    if size > pageMaxBytes or (
+        contentType and not contentType.startswith(pageTypes)
+    ):
+        print(f"pageText skipped {contentType} page of {size} bytes - {url}")
+    elif urlparse(url).path.lower().endswith(".pdf") or contentType.startswith(
+        "application/pdf"
+    ):
+        s = time.perf_counter()
+        try:
+            information = pdfReader(url).lower()  # handles PDFs
+        except (
+            httpx.HTTPError,
+            OSError,
+            ValueError,
+            RuntimeError,
+            concurrent.futures.TimeoutError,
+        ) as exc:
+            print(f"pdfReader failed - {url}: {exc!r}")
+        f = time.perf_counter()
+        print(f"pdfReader: {str(f - s)} seconds")
+    else:
+        content = download(url, pageMaxBytes)
+        if content is None:
+            print(f"pageText skipped page over {pageMaxBytes} bytes - {url}")
+            return ""  # not cached, since the size was not known beforehand
+
+        # skips parsing pages that never mention the candidate, which is only
+        # checked for plain names that cannot be hidden by html entities
+        raw = content.lower()
+        if (
+            names
+            and all(name.isascii() and name.isalpha() for name in names)
+            and not any(name.lower().encode() in raw for name in names)
+        ):
+            return ""  # not cached, since other candidates may share the page
+
+        tree = HTMLParser(content)  # obtains html text of page
+        tree.strip_tags(["script", "style"])  # removes all javascript and css from page
+        information = (
+            tree.body.text(separator=" ", strip=True).strip().lower()
+            if tree.body
+            else ""
+        )  # removes html tags, leading and trailing whitespaces, and makes text lowercase
+
+    with pageCacheLock:
+        pageCache[key] = information
+        if len(pageCache) > pageCacheSize:
+            pageCache.popitem(last=False)
+
+    return information
+
+
 def pdfReader(url):
     """
     Description
@@ -278,17 +496,153 @@ def pdfReader(url):
         the pdf.
     """
 
+    data = download(url, pdfMaxBytes)  # opens pdf
+    if data is None:
+        print(f"pdfReader skipped oversized pdf - {url}")
+        return ""
+
+    pool = pdfPool()
+    try:
+        return pool.submit(pdfText, data).result(timeout=pdfTimeout)
+    except concurrent.futures.BrokenExecutor:
+        resetPdfPool(pool)  # a crashed worker breaks the pool for every pdf
+        raise
+    except concurrent.futures.TimeoutError:
+        resetPdfPool(pool)  # a stuck worker would hold its process forever
+        raise
+
+
+def download(url, maxBytes):
+    """
+    Description
+        - Downloads the body of a URL, stopping as soon as it grows past a
+        maximum size so that oversized responses are never read in full.
+    Parameters
+        - url: a string that represents the web URL being downloaded.
+        - maxBytes: an int that represents the largest body, in bytes, that is
+        downloaded.
+    Return
+        - The bytes of the body, or None if the body is larger than maxBytes.
+        Raises httpx.HTTPStatusError if the server returns an error status.
+    """
+
+    with hostSlot(url):
+        with scrapeClient.stream("GET", url) as r:
+            r.raise_for_status()
+            if int(r.headers.get("Content-Length") or 0) > maxBytes:
+                return None
+
+            # reads the body in chunks, since Content-Length may be missing or wrong
+            chunks, size = [], 0
+            for chunk in r.iter_bytes():
+                size += len(chunk)
+                if size > maxBytes:
+                    return None
+                chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+def pdfText(data):
+    """
+    Description
+        - Extracts the plain text of up to the first 3 pages of a downloaded pdf.
+        Runs in a worker process of pdfPool().
+    Parameters
+        - data: the bytes of a pdf.
+    Return
+        - A string representing the plain text of up to the first 3 pages of
+        the pdf.
+    """
+
     text = []
 
-    with urllib.request.urlopen(url) as response:  # opens pdf
-        with io.BytesIO(response.read()) as file:  # reads pdf
-            reader = PyPDF2.PdfReader(file)
-            for page in range(min(3, len(reader.pages))):
-                text.append(reader.pages[page].extract_text())  # scrapes pdf
+    pdf = pdfium.PdfDocument(data)  # reads pdf
+    try:
+        for page in range(min(3, len(pdf))):
+            text.append(pdf[page].get_textpage().get_text_range())  # scrapes pdf
+    finally:
+        pdf.close()
 
     return " ".join(text)
 
 
+def pdfPool():
+    """
+    Description
+        - Gets the process pool used to extract pdf text, starting it the first
+        time a pdf is scraped.
+    Parameters
+        - None.
+    Return
+        - A concurrent.futures.ProcessPoolExecutor with pdfWorkers processes
+        that is shared by all scraping threads and shut down when the program
+        exits. The workers are started with forkserver where available, and
+        spawn otherwise.
+    """
+
+    global pdfProcesses
+
+    with pdfProcessesLock:
+        if pdfProcesses is None:
+            method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+            pdfProcesses = concurrent.futures.ProcessPoolExecutor(
+                pdfWorkers, mp_context=multiprocessing.get_context(method)
+            )
+            atexit.register(pdfProcesses.shutdown)
+        return pdfProcesses
+
+
+def resetPdfPool(pool):
+    """
+    Description
+        - Discards a process pool that was broken by a crashed worker or has a
+        worker stuck past pdfTimeout, so that the next call to pdfPool() starts
+        a new one. The workers of the old pool are terminated.
+    Parameters
+        - pool: the concurrent.futures.ProcessPoolExecutor that raised
+        BrokenProcessPool or timed out.
+    Return
+        - None.
+    """
+
+    global pdfProcesses
+
+    with pdfProcessesLock:
+        if pdfProcesses is not pool:  # another thread already replaced it
+            return
+        pdfProcesses = None
+
+    # other threads waiting on this pool get BrokenProcessPool and fail their pdf
+    if hasattr(pool, "terminate_workers"):
+        pool.terminate_workers()  # Python 3.14+
+    else:
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def hostSlot(url):
+    """
+    Description
+        - Gets the semaphore that limits the number of concurrent requests made
+        to the host of a URL.
+    Parameters
+        - url: a string that represents the web URL being requested.
+    Return
+        - A threading.Semaphore shared by all requests to the host of the URL,
+        which allows at most hostLimit of them to run at the same time.
+    """
+
+    host = urlparse(url).netloc
+    with hostSlotsLock:
+        return hostSlots[host]
+
+
 def grabber(information, phrase):
     """
     Description
@@ -304,20 +658,31 @@ def grabber(information, phrase):
         occurrence of a specified phrase on a webpage or pdf.
     """
 
-    excerpt = information.partition(
+    start = information.find(
         phrase
-    )  # splits text at the first appearance of specified phrase
-    text = excerpt[1] + excerpt[2]
-    text = re.sub(
-        r"\s*\n\s*", " ", text
-    )  # removes extra newlines and white spaces to improve word counting
-    words = text.split(" ")
-    if "accessibility" in words[:400]:
+    )  # starts at the first appearance of specified phrase
+    if start < 0:
+        return ""
+    end = start + grabberWindow
+
+    # only normalizes and splits a window of text large enough for 400 words
+    while True:
+        text = information[start:end]
+        if end < len(information):
+            text = text.rstrip()  # avoids cutting a run of whitespace in half
+        text = newlines.sub(
+            " ", text
+        )  # removes extra newlines and white spaces to improve word counting
+        words = text.split(" ", 400)
+        if len(words) > 400 or end >= len(information):
+            break
+        end += end - start
+    try:
         end = words.index(
-            "accessibility"
+            "accessibility", 0, 400
         )  # this phrase is usually followed by long text with no spaces which messes up word counting and causes prompt to go over token limit
         numWords = end + 1
-    else:
+    except ValueError:
         numWords = 400
     extractedWords = words[:numWords]
     summary = " ".join(
@@ -342,22 +707,15 @@ def chatPrompt(info):
         URLs is a string array.
     """
 
-    p = f"Extract ONLY the College Major, Undergraduate Institution, Highest Degree \
-        and Institution, and Work History of {info['Full'].title()}, a state representative \
-        candidate from {info['State']}, from the following text: {info['Prompt']}. If any desired \
-        information is not present in the given text, write N/A instead. Determine \
-        your confidence that the information you previously extracted correctly \
-        describes {info['Full'].title()}, a {info['Min Year']} state representative candidate from \
-        {info['State']}, on a scale of 1 to 100. Display the college major, undergraduate \
-        institution, highest degree and institution, work history, and your confidence \
-        level as 5 elements of a JSON object."
-
-    info["Prompt"] = f"{p} {info['Prompt']}"
+    full = info["Full"].title()
+    info["Prompt"] = promptTemplate(
+        full=full, state=info["State"], year=info["Min Year"], text=info["Prompt"]
+    )
 
     return info
 
 
-def retrieveCSV(prompts):
+def retrieveCSV(prompts, timeouts=(), engine="pandas"):
     """
     Description
         - Processes the data gathered in the data retrieval phrase and converts
@@ -370,81 +728,132 @@ def retrieveCSV(prompts):
         dictionary containing the ChatGPT prompt, source URLs, full name, min year,
         state, and candid of the candidate. The value containing the source
         URLs is a string array.
+        - timeouts: an array containing the candidates whose web scraping timed
+        out. Each element is itself a dictionary with the same keys as a row of
+        b1_searches.csv.
+        - engine: a string that specifies the library used to write the CSVs.
+        Can be either "pandas" or "pyarrow", whose multithreaded writer is
+        faster for large prompt CSVs.
     Return
         - A dataframe containing each candidate’s ChatGPT prompt, sources, full
         name, min year, state, and candid. This dataframe is also output to
         c1_retrievals.csv.
     """
 
+    # verifies parameters
+    assert engine in ["pandas", "pyarrow"]
+
     # creates CSV containing candidates whose web scraping timed out
-    failData = {
-        "Sources": [],
-        "First": [],
-        "Middle": [],
-        "Last": [],
-        "Full": [],
-        "Min Year": [],
-        "State": [],
-        "Candid": [],
-    }
-    for cand in timeoutCandidates:
-        if len(cand) == 8:  # verifies candidate info has correct format
-            try:
-                failData["Sources"].append(cand["Sources"])
-                failData["First"].append(cand["First"])
-                failData["Middle"].append(cand["Middle"])
-                failData["Last"].append(cand["Last"])
-                failData["Full"].append(cand["Full"])
-                failData["Min Year"].append(cand["Min Year"])
-                failData["State"].append(cand["State"])
-                failData["Candid"].append(cand["Candid"])
-            except:
-                continue
-    df = pd.DataFrame(
-        failData,
-        columns=[
-            "Sources",
-            "First",
-            "Middle",
-            "Last",
-            "Full",
-            "Min Year",
-            "State",
-            "Candid",
-        ],
-    )
-    df.to_csv("c2_scrapingTimeouts.csv")
+    timeoutCSV(timeouts, engine)
 
     # creates CSV containing ChatGPT prompts and other relevant candidate info
-    rawData = {
-        "ChatGPT Prompt": [],
-        "Sources": [],
-        "Full Name": [],
-        "Min Year": [],
-        "State": [],
-        "Candid": [],
-    }
-    for cand in prompts:
-        if cand != None:
-            try:
-                rawData["ChatGPT Prompt"].append(cand["Prompt"])
-                rawData["Sources"].append(cand["Sources"])
-                rawData["Full Name"].append(cand["Full"])
-                rawData["Min Year"].append(cand["Min Year"])
-                rawData["State"].append(cand["State"])
-                rawData["Candid"].append(cand["Candid"])
-            except:
-                continue
-    df = pd.DataFrame(
-        rawData,
-        columns=[
-            "ChatGPT Prompt",
-            "Sources",
-            "Full Name",
-            "Min Year",
-            "State",
-            "Candid",
-        ],
-    )
-    df.to_csv("c1_retrievals.csv", escapechar="/")
+    df = pd.DataFrame.from_records(
+        [cand for cand in prompts if cand is not None],
+        columns=["Prompt", "Sources", "Full", "Min Year", "State", "Candid"],
+    ).rename(columns={"Prompt": "ChatGPT Prompt", "Full": "Full Name"})
+    df = df.dropna(subset=["ChatGPT Prompt", "Full Name"])
+    writeCSV(df, "c1_retrievals.csv", engine, escapechar="/")
     return df
+
+
+def timeoutCSV(timeouts, engine="pandas"):
+    """
+    Description
+        - Outputs the candidates whose web scraping timed out to
+        c2_scrapingTimeouts.csv, which can be passed back into retrieve() as the
+        searchData to retry scraping them.
+    Parameters
+        - timeouts: an array containing the candidates whose web scraping timed
+        out. Each element is itself a dictionary with the same keys as a row of
+        b1_searches.csv.
+        - engine: a string that specifies the library used to write the CSV.
+        Can be either "pandas" or "pyarrow".
+    Return
+        - None. The candidates are output to c2_scrapingTimeouts.csv.
+    """
+
+    failed = [
+        cand for cand in timeouts if len(cand) == 8
+    ]  # verifies candidate info has correct format
+    df = pd.DataFrame.from_records(failed, columns=searchColumns)
+    writeCSV(df, "c2_scrapingTimeouts.csv", engine)
+
+
+def retrievalRow(cand):
+    """
+    Description
+        - Formats a candidate's ChatGPT prompt and other relevant info as a row
+        of c1_retrievals.csv, matching how pandas writes the same values.
+    Parameters
+        - cand: a dictionary containing the ChatGPT prompt, source URLs, full
+        name, min year, state, and candid of the candidate.
+    Return
+        - A list of the row's values in the order of retrievalColumns, or None
+        if the candidate has no prompt or full name.
+    """
+
+    row = [
+        cand["Prompt"],
+        cand["Sources"],
+        cand["Full"],
+        cand["Min Year"],
+        cand["State"],
+        cand["Candid"],
+    ]
+    missing = [
+        value is None or (isinstance(value, float) and value != value) for value in row
+    ]
+    if missing[0] or missing[2]:
+        return None
+    return [
+        "" if isMissing else value for value, isMissing in zip(row, missing)
+    ]  # writes missing values as empty fields
+
+
+def writeCSV(df, file, engine="pandas", escapechar=None):
+    """
+    Description
+        - Writes a dataframe produced in the data retrieval phase to a CSV.
+    Parameters
+        - df: a pandas dataframe whose Sources column contains string arrays.
+        - file: a string that represents the relative path of the output CSV.
+        - engine: a string that specifies the library used to write the CSV.
+        Can be either "pandas" or "pyarrow".
+        - escapechar: a character used by pandas to escape special characters.
+        The pyarrow writer always quotes strings and doubles embedded quotes,
+        so it does not need one.
+    Return
+        - None. The dataframe is output to the specified CSV without its index.
+    """
+
+    if engine == "pyarrow":
+        table = pa.Table.from_pandas(
+            df.astype({"Sources": "str"}), preserve_index=False
+        )  # stores the source URL arrays the same way pandas does
+        with open(file, "wb", buffering=outputBuffer) as f:
+            pacsv.write_csv(table, f)
+    else:
+        with open(
+            file, "w", buffering=outputBuffer, encoding="utf-8", newline=""
+        ) as f:
+            df.to_csv(f, escapechar=escapechar, index=False)
+
+
+def logError(message):
+    """
+    Description
+        - Appends an error message to errors.txt through a single buffered file
+        handle that is shared by all threads and flushed when the program exits.
+    Parameters
+        - message: a string describing the error.
+    Return
+        - None. The message is written to errors.txt.
+    """
+
+    global errorLog
+
+    with errorLogLock:
+        if errorLog is None:  # opens errors.txt on the first error
+            errorLog = open("errors.txt", "a", buffering=65536)
+            atexit.register(errorLog.close)
+        errorLog.write(message)
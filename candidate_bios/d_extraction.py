@@ -15,17 +15,32 @@ be retried directly from the file, and the results were stored in d4_reruns.csv.
 """
 
 # Imports
+import atexit
 import concurrent.futures
+import contextlib
+import csv
 from dotenv import load_dotenv
+import hashlib
+import httpx
+import io
+import itertools
 import json
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    BadRequestError,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 import os
 import pandas as pd
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-)
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import queue
+import random
+import sqlite3
+import threading
+import tiktoken
 import time
 
 # Setup
@@ -39,9 +54,135 @@ load_dotenv()
 openai_api_key = os.environ.get("openai_api_key")
 assert openai_api_key
 
+extractWorkers = 32  # maximum number of concurrent ChatGPT API requests
+batchSize = 50000  # maximum number of requests in one OpenAI batch
+batchPoll = 60  # seconds between checks on the status of OpenAI batches
+chatModel = "gpt-3.5-turbo-0125"
+chatMaxTokens = 200  # maximum number of tokens in each ChatGPT response
+chatRPM = 3500  # ChatGPT API requests per minute allowed by the account
+chatTPM = 60000  # ChatGPT API tokens per minute allowed by the account
+chatEncoding = tiktoken.encoding_for_model(chatModel)
+chatAttempts = 6  # attempts made for each prompt before it is a prompt error
+chatSystemJSON = (
+    "Act as a summarizer. Respond in JSON, giving each summary the keys College "
+    "Major, Undergraduate Institution, Highest Degree and Institution, Work "
+    "History, and Confidence Level."
+)  # system message of JSON mode requests, which must mention JSON
+packSize = 8  # prompts summarized in one ChatGPT request when packing prompts
+chatContext = 16385  # tokens in the context window of chatModel
+packOverhead = 200  # tokens of the system message and packing instructions
+promptColumns = {  # maps the columns of each retrieval CSV format to prompt keys
+    "regular": {
+        "ChatGPT Prompt": "Prompt",
+        "Sources": "Sources",
+        "Full Name": "Full Name",
+        "Min Year": "Min Year",
+        "State": "State",
+        "Candid": "Candid",
+    },
+    "condensed": {
+        "chatgptprompt": "Prompt",
+        "sources": "Sources",
+        "fullname": "Full Name",
+        "minyear": "Min Year",
+        "state": "State",
+        "candid": "Candid",
+    },
+}
+responseCacheFile = "./chatCache.sqlite3"  # ChatGPT responses keyed by request hash
+responseCache = None  # opened by chatCache() on the first request
+responseCacheLock = threading.Lock()
+pendingResponses = {}  # request hash to the Future of a request already in flight
+readBlock = 1 << 20  # bytes of a retrieval CSV parsed at a time when streaming
+maxInFlight = 2000  # maximum number of ChatGPT requests submitted but not done
+outputBuffer = 1 << 20  # bytes buffered before each write to an output CSV
+extractionColumns = [
+    "Name",
+    "State",
+    "Min Year",
+    "Candid",
+    "College Major",
+    "Undergraduate Institution",
+    "Highest Degree and Institution",
+    "Work History",
+    "Sources",
+    "ChatGPT Confidence",
+]
+rerunOutput = None  # d4_reruns.csv handle and DictWriter, opened by rerunWriter()
+
+# keeps connections to the OpenAI API alive across all ChatGPT requests
+client = OpenAI(
+    api_key=openai_api_key,
+    max_retries=10,
+    http_client=httpx.Client(
+        limits=httpx.Limits(
+            max_connections=extractWorkers, max_keepalive_connections=extractWorkers
+        )
+    ),
+)
+
+
+# retries are handled by chatFeed, so that rate limits reach requestBucket
+chatClient = client.with_options(max_retries=0)
+
+
+class TokenBucket:
+    """
+    Description
+        - Thread-safe token bucket that paces the calls of all threads. Tokens
+        refill at rate per second up to capacity. The rate adapts to the API,
+        halving whenever a request is rate limited and slowly recovering toward
+        maxRate with each success.
+    Parameters
+        - rate: a number that specifies the maximum number of tokens per second.
+        - capacity: a number that specifies the maximum number of tokens that
+        can build up while the bucket is idle.
+    """
+
+    def __init__(self, rate, capacity):
+        self.maxRate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # reserves the tokens, then waits until the bucket has refilled enough
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def increaseRate(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 100)
+
+    def decreaseRate(self):
+        with self.lock:
+            self.rate = max(self.maxRate / 100, self.rate / 2)
+
+    def refund(self, amount):
+        # returns tokens that were reserved but not used, or takes more if the
+        # amount is negative
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+# paces ChatGPT requests and tokens across all threads, starting at the account
+# limits, so that long prompts wait for token budget instead of hitting 429s
+requestBucket = TokenBucket(chatRPM / 60, extractWorkers)
+tokenBucket = TokenBucket(chatTPM / 60, chatTPM / 10)
+
 
 # Data Extraction
-def extract(csvColumns="regular"):
+def extract(csvColumns="regular", mode="online", pack=False, frame=True):
     """
     Description
         - Wrapper function used to run the data extraction phase.
@@ -52,96 +193,47 @@ def extract(csvColumns="regular"):
         "State", and "Candid". If csvColumns is set to "condensed", then the
         program parses the column names "chatgptprompt", "sources", "fullname",
         "minyear", "state", and "candid".
+        - mode: a string that specifies how the prompts are sent to the ChatGPT
+        API. If mode is set to "online", each prompt is sent as its own request.
+        If mode is set to "batch", the prompts are submitted through the OpenAI
+        Batch API, which costs half as much but can take up to 24 hours.
+        - pack: a boolean that specifies whether online requests each summarize
+        packSize prompts at once, which uses fewer requests per minute.
+        - frame: a boolean that specifies whether the results are read back
+        into a dataframe, as in extractCSV().
     Return
         - A dataframe containing each candidate’s name, state, min year, candid,
         college major, undergraduate institution, highest degree and institution,
         work history, sources, and ChatGPT confidence. This dataframe is also
-        output to d1_extractions.csv.
+        output to d1_extractions.csv. If frame is set to False, the path of
+        d1_extractions.csv is returned instead.
     """
 
     # verifies parameters
     assert csvColumns in ["regular", "condensed"]
+    assert mode in ["online", "batch"]
 
     startExtract = time.perf_counter()
 
-    # processes retrieval data
-    if csvColumns == "regular":
-        try:
-            df = pd.read_csv(retrievalData, index_col=None, encoding="latin-1")
-            prompts = [
-                {
-                    "Prompt": prompt,
-                    "Sources": sources,
-                    "Full Name": full_name,
-                    "Min Year": min_year,
-                    "State": state,
-                    "Candid": candid,
-                }
-                for prompt, sources, full_name, min_year, state, candid in zip(
-                    df["ChatGPT Prompt"],
-                    df["Sources"],
-                    df["Full Name"],
-                    df["Min Year"],
-                    df["State"],
-                    df["Candid"],
-                )
-            ]
-        except:
-            print("extract - retrievalData processing error")
-    elif csvColumns == "condensed":
-        try:
-            df = pd.read_csv(retrievalData, index_col=None, encoding="latin-1")
-            prompts = [
-                {
-                    "Prompt": prompt,
-                    "Sources": sources,
-                    "Full Name": full_name,
-                    "Min Year": min_year,
-                    "State": state,
-                    "Candid": candid,
-                }
-                for prompt, sources, full_name, min_year, state, candid in zip(
-                    df["chatgptprompt"],
-                    df["sources"],
-                    df["fullname"],
-                    df["minyear"],
-                    df["state"],
-                    df["candid"],
-                )
-            ]
-        except:
-            print("extract - retrievalData processing error")
-
-    # summarizes prompts using ChatGPT API and multithreading
-    outputs = []
-    promptErrors = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(chatFeed, prompt): prompt for prompt in prompts}
-        for future in concurrent.futures.as_completed(futures):
-            output = futures[future]
-            try:
-                outputs.append(future.result())
-            except Exception as exc:
-                print(f"{output} extract - chatFeed generated an exception: {exc}")
-                promptErrors += [output]
-                with open("errors.txt", "a") as f:
-                    f.write(
-                        f"\n\n{output} extract - chatFeed generated an exception: {exc}"
-                    )
-    doneFeed = time.perf_counter()
-    print(f"chatFeed: {doneFeed - startExtract} seconds")
+    # streams retrieval data into the ChatGPT API as it is parsed
+    prompts = streamPrompts(retrievalData, csvColumns)
+    if mode == "batch":
+        outputs, promptErrors = batchPrompts(list(prompts), "extract")
+    else:
+        promptErrors = []
+        outputs = feedOutputs(prompts, "extract", promptErrors, pack)
 
-    # creates CSVs containing the final results and errors
-    extractions = extractCSV(outputs, promptErrors, variant="normal")
+    # parses and writes each response as soon as it arrives
+    extractions = extractCSV(outputs, promptErrors, variant="normal", frame=frame)
     doneExtractCSV = time.perf_counter()
-    print(f"extractCSV: {doneExtractCSV - doneFeed} seconds")
+    print(f"chatFeed and extractCSV: {doneExtractCSV - startExtract} seconds")
 
     doneExtract = time.perf_counter()
     print(f"data extraction: {doneExtract - startExtract} seconds")
     return extractions
 
 
-def extractAgain(attempt="first"):
+def extractAgain(attempt="first", frame=True):
     """
     Description
         - Wrapper function used to rerun the data extraction phase for candidates
@@ -153,11 +245,14 @@ def extractAgain(attempt="first"):
         to an already existing d4_reruns.csv. This allows the function to be called
         multiple times without erasing the progress from previous reruns. attempt
         is set to "first" by default.
+        - frame: a boolean that specifies whether the results are read back
+        into a dataframe, as in extractCSV().
     Return
         - A dataframe containing each rerun candidate’s name, state, min year,
         candid, college major, undergraduate institution, highest degree and
         institution, work history, sources, and ChatGPT confidence. This dataframe
-        is also output to d4_reruns.csv.
+        is also output to d4_reruns.csv. If frame is set to False, the path of
+        d4_reruns.csv is returned instead.
     """
 
     # verifies parameters
@@ -165,64 +260,192 @@ def extractAgain(attempt="first"):
 
     startRerun = time.perf_counter()
 
-    # processes prompt error data
-    df = pd.read_csv(promptErrorData, index_col=None, encoding="latin-1")
-    prompts = [
-        {
-            "Prompt": prompt,
-            "Sources": sources,
-            "Full Name": full_name,
-            "Min Year": min_year,
-            "State": state,
-            "Candid": candid,
-        }
-        for prompt, sources, full_name, min_year, state, candid in zip(
-            df["ChatGPT Prompt"],
-            df["Sources"],
-            df["Full Name"],
-            df["Min Year"],
-            df["State"],
-            df["Candid"],
-        )
-    ]
-
-    # summarizes prompts using ChatGPT API and multithreading
-    outputs = []
+    # streams prompt error data into the ChatGPT API as it is parsed
+    prompts = itertools.islice(streamPrompts(promptErrorData), 2000, None)
     promptErrors = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {
-            executor.submit(chatFeed, prompt): prompt for prompt in prompts[2000:]
-        }
-        for future in concurrent.futures.as_completed(futures):
-            output = futures[future]
-            try:
-                outputs.append(future.result())
-            except Exception as exc:
-                print(f"{output} rerun - chatFeed generated an exception: {exc}")
-                promptErrors += [output]
-                with open("errors.txt", "a") as f:
-                    f.write(
-                        f"\n\n{output} rerun - chatFeed generated an exception: {exc}"
-                    )
-    doneFeed = time.perf_counter()
-    print(f"chatFeed: {doneFeed - startRerun} seconds")
+    outputs = feedOutputs(prompts, "rerun", promptErrors)
 
-    # creates CSVs containing the final results and errors
-    reruns = extractCSV(outputs, promptErrors, variant="rerun", attempt=attempt)
+    # parses and writes each response as soon as it arrives
+    reruns = extractCSV(
+        outputs, promptErrors, variant="rerun", attempt=attempt, frame=frame
+    )
     doneRerunCSV = time.perf_counter()
-    print(f"rerunCSV: {doneRerunCSV - doneFeed} seconds")
+    print(f"chatFeed and rerunCSV: {doneRerunCSV - startRerun} seconds")
 
     doneRerun = time.perf_counter()
     print(f"prompt error rerun: {doneRerun - startRerun} seconds")
     return reruns
 
 
-@retry(
-    wait=wait_random_exponential(min=1, max=60),
-    stop=stop_after_attempt(6),
-    before_sleep=lambda _: print("retrying chatFeed"),
-)
-def chatFeed(p):
+def readRetrievals(file, csvColumns="regular"):
+    """
+    Description
+        - Reads only the prompt columns of a retrieval or prompt error CSV, using
+        the multithreaded PyArrow parser and Arrow-backed columns.
+    Parameters
+        - file: a string representing the path to the CSV.
+        - csvColumns: a string that describes the names of the columns of the
+        CSV, as in extract().
+    Return
+        - A dataframe containing the ChatGPT prompt, source URLs, full name, min
+        year, state, and candid of each candidate.
+    """
+
+    return pd.read_csv(
+        file,
+        usecols=list(promptColumns[csvColumns]),
+        encoding="latin-1",
+        engine="pyarrow",
+        dtype_backend="pyarrow",
+    )
+
+
+def streamPrompts(file, csvColumns="regular"):
+    """
+    Description
+        - Lazily reads the prompt columns of a retrieval or prompt error CSV,
+        parsing readBlock bytes at a time with PyArrow.
+    Parameters
+        - file: a string representing the path to the CSV.
+        - csvColumns: a string that describes the names of the columns of the
+        CSV, as in extract().
+    Return
+        - An iterator whose elements are dictionaries containing the ChatGPT
+        prompt, source URLs, full name, min year, state, and candid of a
+        candidate as keys.
+    """
+
+    columns = promptColumns[csvColumns]
+    reader = pacsv.open_csv(
+        file,
+        read_options=pacsv.ReadOptions(encoding="latin-1", block_size=readBlock),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=list(columns),
+            column_types={
+                column: pa.int64() if key == "Min Year" else pa.string()
+                for column, key in columns.items()
+            },  # fixes the types so that later blocks match the first block
+        ),
+    )
+    for batch in reader:
+        for record in batch.to_pylist():
+            yield {columns[column]: value for column, value in record.items()}
+
+
+def feedPrompts(prompts, stage, pack=False, jsonMode=True):
+    """
+    Description
+        - Summarizes a set of prompts using the ChatGPT API and waits for all of
+        the responses.
+    Parameters
+        - prompts, stage, pack, jsonMode: as in feedOutputs().
+    Return
+        - A tuple of two arrays. The first contains the output of chatFeed for
+        each prompt that succeeded, in the order the responses arrived. The
+        second contains the prompts that encountered errors.
+    """
+
+    promptErrors = []
+    outputs = list(feedOutputs(prompts, stage, promptErrors, pack, jsonMode))
+    return outputs, promptErrors
+
+
+def feedOutputs(prompts, stage, promptErrors, pack=False, jsonMode=True):
+    """
+    Description
+        - Summarizes a set of prompts using the ChatGPT API, with at most
+        extractWorkers requests in flight at the same time, yielding each
+        output as soon as its response arrives.
+    Parameters
+        - prompts: an array or iterator whose elements are dictionaries
+        containing the ChatGPT prompt, source URLs, full name, min year, state,
+        and candid of a candidate as keys.
+        - stage: a string naming the calling phase, such as "extract" or
+        "rerun", which is used in the error messages.
+        - promptErrors: an array that the prompts which encountered errors are
+        appended to.
+        - pack: a boolean that specifies whether to summarize packSize prompts
+        in each request using chatFeedBatch() instead of one prompt per request
+        using chatFeed().
+        - jsonMode: a boolean that specifies whether the responses are JSON
+        summaries, as in chatRequest().
+    Return
+        - An iterator over the output of chatFeed for each prompt that
+        succeeded, in the order the responses arrived.
+    """
+
+    # groups up to packSize prompts that fit in one context into each request
+    # when packing
+    prompts = iter(prompts)
+    if pack:
+        groups = packPrompts(prompts)
+    else:
+        groups = iter(lambda: list(itertools.islice(prompts, 1)), [])
+
+    with concurrent.futures.ThreadPoolExecutor(extractWorkers) as executor:
+        # only reads more prompts while fewer than maxInFlight requests are
+        # pending, so that streamed prompts are not all held in memory at once
+        pending = {}  # request futures to their prompts, until they finish
+        finished = queue.SimpleQueue()  # request futures in order of completion
+        for group in itertools.chain(groups, [None]):
+            if group is not None:
+                future = executor.submit(chatFeedBatch, group, jsonMode)
+                pending[future] = group
+                future.add_done_callback(finished.put)
+            # yields every finished request, waiting for one while maxInFlight
+            # requests are pending, or for all of them once every prompt is read
+            while pending:
+                wait = group is None or len(pending) >= maxInFlight
+                try:
+                    future = finished.get(block=wait)
+                except queue.Empty:
+                    break
+                completed = pending.pop(future)
+                try:
+                    yield from future.result()
+                except Exception as exc:
+                    output = completed[0] if len(completed) == 1 else completed
+                    print(f"{output} {stage} - chatFeed generated an exception: {exc}")
+                    promptErrors += completed
+                    with open("errors.txt", "a") as f:
+                        f.write(
+                            f"\n\n{output} {stage} - chatFeed generated an exception: {exc}"
+                        )
+
+
+def packPrompts(prompts):
+    """
+    Description
+        - Groups prompts into packs for chatFeedBatch(). Each pack has at most
+        packSize prompts, and its packed request, together with the response
+        tokens of every prompt in it, fits in the chatContext tokens of
+        chatModel. A prompt too long to share a request is packed alone.
+    Parameters
+        - prompts: an iterator whose elements are dictionaries containing the
+        ChatGPT prompt, source URLs, full name, min year, state, and candid of a
+        candidate as keys.
+    Return
+        - An iterator over arrays of prompts, in the order of prompts.
+    """
+
+    group = []
+    groupTokens = packOverhead
+    for p in prompts:
+        promptTokens = len(chatEncoding.encode(str(p["Prompt"]))) + chatMaxTokens + 10
+        if group and (
+            len(group) == packSize or groupTokens + promptTokens > chatContext
+        ):
+            yield group
+            group = []
+            groupTokens = packOverhead
+        group.append(p)
+        groupTokens += promptTokens
+    if group:
+        yield group
+
+
+def chatFeed(p, jsonMode=True):
     """
     Description
         - Uses the ChatGPT API to summarize the biodata from the scraped text
@@ -231,78 +454,364 @@ def chatFeed(p):
         - p: A dictionary containing the ChatGPT prompt, source URLs, full name,
         min year, state, and candid of a candidate as keys. The value containing
         the source URLs is a string array.
+        - jsonMode: a boolean that specifies whether the response is a JSON
+        summary, as in chatRequest().
     Return
         - A dictionary containing the ChatGPT response, source URLs, full name,
         min year, state, and candid of a candidate as keys. The value containing
         the source URLs is a string array.
     """
 
-    # gets ChatGPT response
-    client = OpenAI(api_key=openai_api_key, max_retries=10)
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo-0125",
-        temperature=0,
-        max_tokens=200,
-        messages=[
+    output = p
+    output["Response"] = chatResponse(p["Prompt"], jsonMode=jsonMode)
+
+    return output
+
+
+def chatFeedBatch(prompts, jsonMode=True):
+    """
+    Description
+        - Uses a single ChatGPT API request to summarize the biodata of several
+        candidates, asking for a JSON object whose "responses" array has one
+        response per prompt. If the request is rejected or the array cannot be
+        read, each prompt is summarized separately using chatFeed() instead.
+    Parameters
+        - prompts: an array of up to packSize dictionaries, each containing the
+        ChatGPT prompt, source URLs, full name, min year, state, and candid of a
+        candidate as keys, as grouped by packPrompts().
+        - jsonMode: a boolean that specifies whether each response is a JSON
+        summary, as in chatRequest().
+    Return
+        - An array of dictionaries with the same format as the return value of
+        chatFeed(), in the same order as prompts.
+    """
+
+    if len(prompts) == 1:
+        return [chatFeed(prompts[0], jsonMode)]
+
+    packed = (
+        f"Complete each of the following {len(prompts)} numbered requests. "
+        'Respond with only a JSON object whose "responses" key is an array of '
+        f"{len(prompts)} responses, one per request, in the same order as the "
+        "requests.\n"
+    ) + "\n".join(f"[{i + 1}] {p['Prompt']}" for i, p in enumerate(prompts))
+    try:
+        content = chatResponse(packed, chatMaxTokens * len(prompts), jsonMode)
+    except BadRequestError as exc:
+        print(f"chatFeedBatch request was rejected, summarizing separately: {exc}")
+        return [chatFeed(p, jsonMode) for p in prompts]
+
+    # matches each response in the array back to its prompt
+    try:
+        responses = json.loads(content)["responses"]
+        assert isinstance(responses, list) and len(responses) == len(prompts)
+    except (json.JSONDecodeError, TypeError, KeyError, AssertionError):
+        print("chatFeedBatch response could not be split, summarizing separately")
+        return [chatFeed(p, jsonMode) for p in prompts]
+
+    outputs = []
+    for p, response in zip(prompts, responses):
+        output = p
+        output["Response"] = (
+            response if isinstance(response, str) else json.dumps(response)
+        )
+        outputs.append(output)
+    return outputs
+
+
+def chatResponse(prompt, maxTokens=chatMaxTokens, jsonMode=True):
+    """
+    Description
+        - Gets the ChatGPT response to a prompt. Responses are cached on disk by
+        a hash of the request, so a prompt that was already summarized with the
+        same model and settings is never sent again.
+    Parameters
+        - prompt: a string representing the ChatGPT prompt.
+        - maxTokens: an integer that specifies the maximum number of tokens in
+        the response.
+        - jsonMode: a boolean that specifies whether the response is a JSON
+        summary, as in chatRequest().
+    Return
+        - A string representing the content of the ChatGPT response.
+    """
+
+    # returns the cached response of an identical request, or waits for it if
+    # another thread is already sending that request
+    request = chatRequest(prompt, maxTokens, jsonMode)
+    key = hashlib.blake2b(
+        json.dumps(request, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+    cache = chatCache()
+    with responseCacheLock:
+        cached = cache.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        pending = pendingResponses.get(key)
+        if cached is None and pending is None:
+            pendingResponses[key] = concurrent.futures.Future()
+    if cached is not None:
+        return cached[0]
+    if pending is not None:
+        return pending.result()
+
+    try:
+        content = chatSend(request, prompt, maxTokens)
+    except Exception as exc:
+        with responseCacheLock:
+            pendingResponses.pop(key).set_exception(exc)
+        raise
+    with responseCacheLock:
+        cache.execute("INSERT OR REPLACE INTO responses VALUES (?, ?)", (key, content))
+        pendingResponses.pop(key).set_result(content)
+
+    return content
+
+
+def chatSend(request, prompt, maxTokens):
+    """
+    Description
+        - Sends a ChatGPT API request, waiting on the shared request and token
+        buckets before each attempt.
+    Parameters
+        - request: a dictionary containing the body of the request, as returned
+        by chatRequest().
+        - prompt: a string representing the ChatGPT prompt of the request.
+        - maxTokens: an integer that specifies the maximum number of tokens in
+        the response.
+    Return
+        - A string representing the content of the ChatGPT response.
+    """
+
+    # gets ChatGPT response, slowing every thread down when rate limited and
+    # backing off exponentially after connection and server errors
+    estimate = len(chatEncoding.encode(str(prompt))) + maxTokens + 20
+    for attempt in range(chatAttempts):
+        lastAttempt = attempt == chatAttempts - 1
+        requestBucket.acquire()
+        tokenBucket.acquire(estimate)
+        try:
+            response = chatClient.chat.completions.create(**request)
+            break
+        except RateLimitError as exc:
+            requestBucket.decreaseRate()
+            tokenBucket.decreaseRate()
+            if lastAttempt:
+                raise
+            time.sleep(retryAfter(exc, attempt))
+        except (APIConnectionError, InternalServerError):
+            if lastAttempt:
+                raise
+            time.sleep(random.uniform(1, min(60, 2**attempt)))
+        print("retrying chatFeed")
+    requestBucket.increaseRate()
+    tokenBucket.increaseRate()
+    if response.usage:
+        tokenBucket.refund(
+            estimate - response.usage.total_tokens
+        )  # corrects the estimate with the tokens actually used
+
+    return response.choices[0].message.content
+
+
+def retryAfter(exc, attempt):
+    """
+    Description
+        - Finds how long to wait before retrying a rate limited ChatGPT API
+        request, using the retry-after headers of the 429 response when present
+        and exponential backoff otherwise.
+    Parameters
+        - exc: the RateLimitError raised by the request.
+        - attempt: an integer that specifies the number of attempts already made
+        minus one.
+    Return
+        - A float representing the number of seconds to wait.
+    """
+
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # falls back on backoff when the header is not a number of seconds
+    return random.uniform(1, min(60, 2**attempt))
+
+
+def chatCache():
+    """
+    Description
+        - Opens the on-disk cache of ChatGPT responses the first time it is
+        needed. The connection is shared by all threads, which use it while
+        holding responseCacheLock.
+    Parameters
+        - None.
+    Return
+        - A sqlite3 connection to responseCacheFile.
+    """
+
+    global responseCache
+
+    with responseCacheLock:
+        if responseCache is None:
+            responseCache = sqlite3.connect(
+                responseCacheFile, check_same_thread=False, isolation_level=None
+            )
+            responseCache.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)"
+            )
+            atexit.register(responseCache.close)
+    return responseCache
+
+
+def chatRequest(prompt, maxTokens=chatMaxTokens, jsonMode=True):
+    """
+    Description
+        - Creates the body of a ChatGPT API request for a prompt.
+    Parameters
+        - prompt: a string representing the ChatGPT prompt of a candidate.
+        - maxTokens: an integer that specifies the maximum number of tokens in
+        the response.
+        - jsonMode: a boolean that specifies whether the response is a JSON
+        summary. If jsonMode is set to True, the request uses JSON mode, which
+        guarantees that the response is a JSON object, and lists the keys of
+        each summary. Set it to False for plain text prompts such as those of
+        getBirthYear().
+    Return
+        - A dictionary containing the model, temperature, max tokens, response
+        format, and messages of the request, which is used by both chatFeed()
+        and batchPrompts().
+    """
+
+    request = {
+        "model": chatModel,
+        "temperature": 0,
+        "max_tokens": maxTokens,
+        "messages": [
             {"role": "system", "content": "Act as a summarizer"},
-            {"role": "system", "content": p["Prompt"]},
+            {"role": "system", "content": prompt},
         ],
-    )
+    }
+    if jsonMode:
+        request["response_format"] = {"type": "json_object"}
+        request["messages"][0]["content"] = chatSystemJSON
+    return request
 
-    output = p
-    output["Response"] = response.choices[0].message.content
 
-    return output
+def batchPrompts(prompts, stage, jsonMode=True):
+    """
+    Description
+        - Summarizes a set of prompts using the OpenAI Batch API. The prompts
+        are uploaded in batches of up to batchSize requests, and the batches are
+        checked every batchPoll seconds until they finish.
+    Parameters
+        - prompts: an array whose elements are dictionaries containing the
+        ChatGPT prompt, source URLs, full name, min year, state, and candid of
+        a candidate as keys.
+        - stage: a string naming the calling phase, such as "extract", which is
+        used in the error messages.
+        - jsonMode: a boolean that specifies whether the responses are JSON
+        summaries, as in chatRequest().
+    Return
+        - A tuple of two arrays with the same format as the return value of
+        feedPrompts(). The first contains the output of each prompt that
+        succeeded, and the second contains the prompts that encountered errors
+        or did not finish before their batch expired.
+    """
+
+    # submits the prompts in batches
+    batchIds = []
+    for start in range(0, len(prompts), batchSize):
+        lines = io.BytesIO()
+        for i in range(start, min(start + batchSize, len(prompts))):
+            request = {
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": chatRequest(prompts[i]["Prompt"], jsonMode=jsonMode),
+            }
+            lines.write(json.dumps(request).encode() + b"\n")
+        upload = client.files.create(
+            file=(f"{stage}{start}.jsonl", lines.getvalue()), purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=upload.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        batchIds.append(batch.id)
+        print(f"{stage} - submitted batch {batch.id}")
 
+    # waits for each batch and collects its responses
+    responses = {}
+    for batchId in batchIds:
+        batch = client.batches.retrieve(batchId)
+        while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+            time.sleep(batchPoll)
+            batch = client.batches.retrieve(batchId)
+        print(f"{stage} - batch {batchId} {batch.status}")
+        if batch.output_file_id:
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                result = json.loads(line)
+                response = result["response"]
+                if response and response["status_code"] == 200:
+                    message = response["body"]["choices"][0]["message"]
+                    responses[int(result["custom_id"])] = message["content"]
 
-def getBirthYear():
+    outputs = []
+    promptErrors = []
+    for i, prompt in enumerate(prompts):
+        if i in responses:
+            output = prompt
+            output["Response"] = responses[i]
+            outputs.append(output)
+        else:
+            print(f"{prompt} {stage} - batch request failed")
+            promptErrors.append(prompt)
+            with open("errors.txt", "a") as f:
+                f.write(f"\n\n{prompt} {stage} - batch request failed")
+    return outputs, promptErrors
+
+
+def getBirthYear(mode="online"):
     """
     Description
         - Processes the retrieval data, extracts the birth year of the candidate, and converts it into a pandas dataframe and CSV.
     Parameters
-        - No input parameters.
+        - mode: a string that specifies how the prompts are sent to the ChatGPT
+        API. Can be either "online" or "batch", as in extract().
     Return
         - A dataframe containing each candidate’s candid and year of birth.
     """
 
+    # verifies parameters
+    assert mode in ["online", "batch"]
+
     retrievalData = "../DataTests/Samples/order1000retrievals.csv"
     # converts the existing scraped data into appropriate prompts to feed into ChatGPT
-    df = pd.read_csv(retrievalData, index_col=None, encoding="latin-1")
-    scraped_text = df["ChatGPT Prompt"].apply(
-        lambda row: row.split("text: ")[-1].split("If any desired")[0]
+    df = readRetrievals(retrievalData)
+    scraped_text = df["ChatGPT Prompt"].str.rpartition("text: ")[2]
+    scraped_text = scraped_text.str.partition("If any desired")[0]
+    df["Prompt"] = (
+        "Print a value indicating the year of birth of "
+        + df["Full Name"]
+        + ", a state representative candidate from "
+        + df["State"]
+        + ". If the year of birth is present, print only the year as a number. If "
+        "the year of undergraduate graduation is present, subtract 22 from that "
+        "year and print that. No full sentences. If the information is not "
+        "present, print N/A, and nothing else: "
+        + scraped_text
     )
-    prompts = []
-    for i in range(len(df)):
-        scraped_text[i] = (
-            f"Print a value indicating the year of birth of {df.iloc[i]['Full Name']}, a state representative candidate from {df.iloc[i]['State']}. If the year of birth is present, print only the year as a number. If the year of undergraduate graduation is present, subtract 22 from that year and print that. No full sentences. If the information is not present, print N/A, and nothing else: {scraped_text[i]}"
-        )
-        prompts.append(
-            {
-                "Prompt": scraped_text[i],
-                "Sources": df.iloc[i]["Sources"],
-                "Full Name": df.iloc[i]["Full Name"],
-                "Min Year": df.iloc[i]["Min Year"],
-                "State": df.iloc[i]["State"],
-                "Candid": df.iloc[i]["Candid"],
-            }
-        )
+    prompts = df[
+        ["Prompt", "Sources", "Full Name", "Min Year", "State", "Candid"]
+    ].to_dict("records")
 
-    # gets candidate years of birth using ChatGPT API and multithreading
-    outputs = []
-    promptErrors = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(chatFeed, prompt): prompt for prompt in prompts}
-        for future in concurrent.futures.as_completed(futures):
-            output = futures[future]
-            try:
-                outputs.append(future.result())
-            except Exception as exc:
-                print(f"{output} extract - chatFeed generated an exception: {exc}")
-                promptErrors += [output]
-                with open("errors.txt", "a") as f:
-                    f.write(
-                        f"\n\n{output} extract - chatFeed generated an exception: {exc}"
-                    )
+    # gets candidate years of birth using ChatGPT API
+    if mode == "batch":
+        outputs, promptErrors = batchPrompts(prompts, "extract", jsonMode=False)
+    else:
+        outputs, promptErrors = feedPrompts(prompts, "extract", jsonMode=False)
 
     yearResults = {"Candid": [], "Birth Year": []}
     for output in outputs:
@@ -315,11 +824,11 @@ def getBirthYear():
             "Birth Year",
         ],
     )
-    df.to_csv("birthYears.csv", index=False)
+    writeTable(df, "birthYears.csv", index=False)
     return df
 
 
-def extractCSV(outputs, promptErrors, variant="normal", attempt="first"):
+def extractCSV(outputs, promptErrors, variant="normal", attempt="first", frame=True):
     """
     Description
         - Processes the data gathered in the data extraction stage and converts
@@ -327,8 +836,8 @@ def extractCSV(outputs, promptErrors, variant="normal", attempt="first"):
         responses, prompt errors, and parse errors, which are stored in
         d1_extractions.csv, d2_promptErrors.csv, and d3_parseErrors.csv, respectively.
     Parameters
-        - outputs: an array containing the relevant candidate information for
-        each candidate as the elements in the array. Each element is itself a
+        - outputs: an array or iterator containing the relevant candidate
+        information for each candidate as the elements. Each element is itself a
         dictionary containing the ChatGPT response, source URLs, full name, min year,
         state, and candid of a candidate as keys. The value containing the source
         URLs is a string array.
@@ -336,7 +845,8 @@ def extractCSV(outputs, promptErrors, variant="normal", attempt="first"):
         prompt errors during the chatFeed function. Each element is itself a
         dictionary containing the ChatGPT prompt, source URLs, full name, min year,
         state, and candid of a candidate. The value containing the source URLs
-        is a string array.
+        is a string array. It is only read once outputs is exhausted, so it can
+        be filled by feedOutputs() while the outputs are written.
         - variant: a string that specifies if the outputs are being processed
         normally or as part of a rerun. If variant is set to "normal", the
         dataframe containing the final results will be output to d1_extractions.csv.
@@ -348,18 +858,78 @@ def extractCSV(outputs, promptErrors, variant="normal", attempt="first"):
         already existing d4_reruns.csv. This allows the function to be called multiple
         times without erasing the progress from previous reruns. attempt is set
         to "first" by default.
+        - frame: a boolean that specifies whether the rows written by this call
+        are read back into a dataframe. Rows are never held in memory while they
+        are written, so setting frame to False keeps memory flat however many
+        rows there are. frame is set to True by default.
     Return
         - A dataframe containing each candidate’s name, state, min year, candid,
         college major, undergraduate institution, highest degree and institution,
         work history, sources, and ChatGPT confidence. If variant is set to
         "normal", this dataframe is also output to d1_extractions.csv. If variant
-        is set to "rerun", this dataframe is instead output to d4_reruns.csv.
+        is set to "rerun", this dataframe is instead output to d4_reruns.csv. If
+        frame is set to False, the path of that CSV is returned instead.
     """
 
     # verifies parameters
     assert variant in ["normal", "rerun"]
     assert attempt in ["first", "later"]
 
+    # streams final results to their CSV as each response is parsed
+    if variant == "normal":
+        out = open("d1_extractions.csv", "w", newline="", buffering=outputBuffer)
+        writer = csv.DictWriter(out, fieldnames=[""] + extractionColumns)
+        writer.writeheader()  # stores results to d1_extractions.csv
+    else:
+        out, writer = rerunWriter(attempt)  # stores or appends to d4_reruns.csv
+    start = out.tell()
+    parseErrors = []
+    with out if variant == "normal" else contextlib.nullcontext():
+        rows = 0
+
+        # parses ChatGPT responses as they arrive
+        for output in outputs:
+            try:
+                data = parse(output)
+                if isinstance(data, list):  # response could not be parsed
+                    parseErrors.append(data[1])
+                    continue
+                writer.writerow(
+                    {
+                        "": rows,
+                        "Name": data["Full Name"],
+                        "State": data["State"],
+                        "Min Year": data["Min Year"],
+                        "Candid": data["Candid"],
+                        "College Major": data["College Major"],
+                        "Undergraduate Institution": data["Undergraduate Institution"],
+                        "Highest Degree and Institution": data[
+                            "Highest Degree and Institution"
+                        ],
+                        "Work History": data["Work History"],
+                        "Sources": data["Sources"],
+                        "ChatGPT Confidence": data["Confidence Level"],
+                    }
+                )
+                rows += 1
+            except Exception as exc:
+                print(f"{output} extract - parse generated an exception: {exc}")
+                with open("errors.txt", "a") as f:
+                    f.write(
+                        f"\n\n{output} extract - parse generated an exception: {exc}"
+                    )
+
+        out.flush()
+
+    # reads back only the rows written by this call, if a dataframe was asked for
+    if frame:
+        with open(out.name, newline="") as f:
+            f.seek(start)
+            df = pd.read_csv(
+                f, header=None, names=[""] + extractionColumns, index_col=0
+            )
+        df.index.name = None
+
     # creates CSV containing prompt errors
     rawPromptErrors = {
         "ChatGPT Prompt": [],
@@ -391,104 +961,93 @@ def extractCSV(outputs, promptErrors, variant="normal", attempt="first"):
                 "Candid",
             ],
         )
-        promptErrorFrame.to_csv("d2_promptErrors.csv")
+        writeTable(
+            promptErrorFrame.astype({"Sources": "str"}), "d2_promptErrors.csv"
+        )
         print(f"\n{promptErrorFrame.head()}\n{len(promptErrorFrame)} rows\n")
     except:
         print("promptErrorFrame not constructed")
 
-    # creates or appends to CSV containing final results
-    parseErrors = []
-    rawResults = {
-        "Name": [],
-        "State": [],
-        "Min Year": [],
-        "Candid": [],
-        "College Major": [],
-        "Undergraduate Institution": [],
-        "Highest Degree and Institution": [],
-        "Work History": [],
-        "Sources": [],
-        "ChatGPT Confidence": [],
-    }
-
-    # parses ChatGPT responses using multithreading
-    with concurrent.futures.ThreadPoolExecutor(max_workers=None) as executor:
-        futures = {executor.submit(parse, output): output for output in outputs}
-        for future in concurrent.futures.as_completed(futures):
-            output = futures[future]
-            try:
-                data = future.result()
-                if data != None:  # verifies data exists
-                    rawResults["Name"].append(data["Full Name"])
-                    rawResults["College Major"].append(data["College Major"])
-                    rawResults["Undergraduate Institution"].append(
-                        data["Undergraduate Institution"]
-                    )
-                    rawResults["Highest Degree and Institution"].append(
-                        data["Highest Degree and Institution"]
-                    )
-                    rawResults["Work History"].append(data["Work History"])
-                    rawResults["ChatGPT Confidence"].append(data["Confidence Level"])
-                    rawResults["Sources"].append(data["Sources"])
-                    rawResults["Min Year"].append(data["Min Year"])
-                    rawResults["State"].append(data["State"])
-                    rawResults["Candid"].append(data["Candid"])
-                elif data[0] == -1:
-                    parseErrors.append(data[1])
-            except Exception as exc:
-                print(f"{output} extract - parse generated an exception: {exc}")
-                with open("errors.txt", "a") as f:
-                    f.write(
-                        f"\n\n{output} extract - parse generated an exception: {exc}"
-                    )
-    try:
-        df = pd.DataFrame(
-            rawResults,
-            columns=[
-                "Name",
-                "State",
-                "Min Year",
-                "Candid",
-                "College Major",
-                "Undergraduate Institution",
-                "Highest Degree and Institution",
-                "Work History",
-                "Sources",
-                "ChatGPT Confidence",
-            ],
-        )
-        if variant == "normal":
-            df.to_csv("d1_extractions.csv")  # stores results to d1_extractions.csv
-        elif variant == "rerun":
-            if attempt == "first":
-                df.to_csv("d4_reruns.csv")  # stores new results in d4_reruns.csv
-            else:
-                df.to_csv(
-                    "d4_reruns.csv", mode="a"
-                )  # appends new results to d4_reruns.csv
-        else:
-            print("invalid extractCSV variant")
-    except:
-        df = -1
-
     # creates or appends to CSV containing parse errors
     rawParseErrors = {"Parse Error": parseErrors}
     try:
-        parseErrorFrame = pd.DataFrame(rawParseErrors, columns=["Parse Error"])
+        parseErrorFrame = pd.DataFrame(
+            rawParseErrors, columns=["Parse Error"], dtype="str"
+        )
         if variant == "normal":
-            parseErrorFrame.to_csv("d3_parseErrors.csv")
+            writeTable(parseErrorFrame, "d3_parseErrors.csv")
         elif variant == "rerun":
-            parseErrorFrame.to_csv("d3_parseErrors.csv", mode="a")
+            writeTable(parseErrorFrame, "d3_parseErrors.csv", append=True)
         else:
             print("invalid extractCSV variant")
         print(f"{parseErrorFrame.head()}\n{len(parseErrorFrame)} rows\n")
     except:
         print("parseErrorFrame not constructed")
 
-    if df.empty:
-        return rawResults
-    else:
-        return df
+    return df if frame else out.name
+
+
+def rerunWriter(attempt):
+    """
+    Description
+        - Opens d4_reruns.csv once per program and reuses it for every later
+        rerun, so that appended reruns do not repeat the header.
+    Parameters
+        - attempt: a string that indicates which type of rerun is being
+        processed, as in extractCSV(). If attempt is set to "first", the file is
+        recreated. If attempt is set to "later", rows are appended and the
+        header is only written if the file is new or empty.
+    Return
+        - A tuple containing the file handle of d4_reruns.csv and a
+        csv.DictWriter that writes the extraction columns to it.
+    """
+
+    global rerunOutput
+
+    if rerunOutput is None or attempt == "first":
+        if rerunOutput is not None:
+            rerunOutput[0].close()
+        else:
+            atexit.register(lambda: rerunOutput[0].close())
+        out = open(
+            "d4_reruns.csv",
+            "w" if attempt == "first" else "a",
+            newline="",
+            buffering=outputBuffer,
+        )
+        writer = csv.DictWriter(out, fieldnames=[""] + extractionColumns)
+        if out.tell() == 0:
+            writer.writeheader()
+        rerunOutput = (out, writer)
+    return rerunOutput
+
+
+def writeTable(df, file, index=True, append=False):
+    """
+    Description
+        - Writes a dataframe to a CSV with the PyArrow CSV writer, which formats
+        the cells in native code instead of row by row in Python.
+    Parameters
+        - df: a pandas dataframe whose columns contain strings or numbers.
+        - file: a string that represents the relative path of the output CSV.
+        - index: a boolean that specifies whether the index of df is written as
+        an unnamed first column, as pandas does by default.
+        - append: a boolean that specifies whether df is appended to file, in
+        which case the header is only written if file is new or empty.
+    Return
+        - None. The dataframe is output to the specified CSV.
+    """
+
+    table = pa.Table.from_pandas(
+        df.reset_index(names="") if index else df, preserve_index=False
+    )
+    header = not append or not os.path.exists(file) or os.path.getsize(file) == 0
+    with open(file, "ab" if append else "wb", buffering=outputBuffer) as f:
+        pacsv.write_csv(
+            table,
+            f,
+            write_options=pacsv.WriteOptions(include_header=header, batch_size=8192),
+        )
 
 
 def parse(output):
@@ -518,7 +1077,10 @@ def parse(output):
         "Confidence Level": "",
     }
     try:
-        d = json.loads(output["Response"].replace("\n", ""))  # splits JSON data
+        response = output["Response"]
+        d = json.loads(
+            response[response.find("{") : response.rfind("}") + 1], strict=False
+        )  # splits JSON data, skipping any text around the object
         data["Sources"] = output["Sources"]
         data["Full Name"] = output["Full Name"]
         data["Min Year"] = output["Min Year"]
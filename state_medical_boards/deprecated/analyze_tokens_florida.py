@@ -10,9 +10,8 @@
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
-from utils import count_tokens, truncate_text_by_max_tokens
+from utils import count_tokens_batch
 
 if __name__ == "__main__":
 
@@ -23,23 +22,15 @@ if __name__ == "__main__":
     print(f"Number of FL cases:", num_cases)
 
     # Counts total tokens
-    tqdm.pandas(desc="Counting total tokens")
-    cases["token_count"] = cases["textdata"].progress_apply(
-        lambda case_text: count_tokens(text=case_text)
+    cases["token_count"] = np.array(
+        count_tokens_batch(cases["textdata"]), dtype=np.int64
     )
     token_count = cases["token_count"].sum()
     print(f"Total tokens:", token_count)
     print(f"Average tokens per case:", np.round(token_count // num_cases))
 
-    # Counts total tokens in truncated case text
-    tqdm.pandas(desc="Truncating case text")
-    cases["truncated_case_text"] = cases["textdata"].progress_apply(
-        lambda case_text: truncate_text_by_max_tokens(text=case_text, max_tokens=12000)
-    )
-    tqdm.pandas(desc="Counting total tokens (truncated)")
-    cases["truncated_token_count"] = cases["truncated_case_text"].progress_apply(
-        lambda case_text: count_tokens(text=case_text)
-    )
+    # Counts total tokens in case text truncated to 12000 tokens
+    cases["truncated_token_count"] = np.minimum(cases["token_count"], 12000)
     truncated_token_count = cases["truncated_token_count"].sum()
     print(f"Total tokens (truncated):", truncated_token_count)
     print(f"Average tokens per case (truncated):", truncated_token_count // num_cases)
@@ -14,12 +14,11 @@ import os
 import pandas as pd
 import time
 import sys
-from tqdm import tqdm
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(project_root)
 
-from utils import chunk_text
+from utils import chunk_texts
 
 if __name__ == "__main__":
 
@@ -47,6 +46,7 @@ if __name__ == "__main__":
         "-cs",
         "--chunk-size",
         help="The size of case document chunks.",
+        type=int,
         choices=[1000, 2500, 5000],
         default=2500,
     )
@@ -71,10 +71,9 @@ if __name__ == "__main__":
     documents_df = pd.read_csv(documents_path)
 
     # Chunks case documents
-    chunk_size = 2500
-    tqdm.pandas(desc="Chunking case documents")
-    documents_df["textdata"] = documents_df["textdata"].progress_apply(
-        lambda case_text: chunk_text(case_text, chunk_size=chunk_size)
+    chunk_size = args.chunk_size
+    documents_df["textdata"] = chunk_texts(
+        documents_df["textdata"], chunk_size=chunk_size
     )
     chunked_documents_df = documents_df.explode("textdata", ignore_index=True)
     if args.verbose:
@@ -7,33 +7,65 @@
 # After DSPY training
 
 import argparse
+import dspy
 import os
 import pandas as pd
 import sys
 import time
-from tqdm import tqdm
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(project_root)
 
-from setup import configure_dspy, SimpleSummaryModel
-from utils import truncate_text_by_max_tokens
+from setup import configure_dspy, run_dspy_program, SimpleSummaryModel
+from utils import truncate_texts_by_max_tokens
 
 
-# Runs summary model on documents
-def summary_helper(row: pd.DataFrame, summary_model, verbose: bool) -> pd.DataFrame:
+# Runs summary model on documents concurrently
+def run_summary_program(
+    documents: pd.DataFrame,
+    summary_model,
+    verbose: bool,
+    concurrency: int = 64,
+    batch: bool = False,
+) -> pd.DataFrame:
 
-    try:
-        truncated_case_text = truncate_text_by_max_tokens(
-            text=row["textdata"], max_tokens=12000
-        )
-        response = summary_model(case_document=truncated_case_text)
+    # Runs the model on every non-empty document
+    empty = documents["textdata"].fillna("").eq("")
+    case_texts = truncate_texts_by_max_tokens(
+        texts=documents.loc[~empty, "textdata"], max_tokens=12000
+    )
+    inputs = [{"case_document": case_text} for case_text in case_texts]
+    responses = run_dspy_program(
+        program=summary_model,
+        inputs=inputs,
+        program_version=f"simple_summary:{dspy.settings.lm.model}",
+        concurrency=concurrency,
+        batch=batch,
+        verbose=verbose,
+    )
+
+    # Maps each response back to its document, failing empty documents
+    responses = dict(zip(documents.index[~empty], responses))
+    summaries = pd.DataFrame(
+        [
+            summary_helper(row=row, response=responses.get(index), verbose=verbose)
+            for index, row in documents.iterrows()
+        ]
+    )
+
+    return summaries
+
+
+# Fills the trouble summary from a summary model response
+def summary_helper(row: pd.Series, response, verbose: bool) -> pd.Series:
+
+    if response is not None:
         row["trouble_summary"] = response.trouble_summary
 
         if verbose:
             print("\nTrouble summary:", response.trouble_summary)
-    except Exception as e:
-        print(f"\nError processing document {row.name}: {str(e)}")
+    else:
+        print(f"\nError processing document {row.name}")
         row["trouble_summary"] = "Failed to process"
 
     return row
@@ -49,6 +81,21 @@ if __name__ == "__main__":
         help="Increase summary program verbosity",
         action="store_true",
     )
+    # Concurrency
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="Number of documents processed concurrently",
+        type=int,
+        default=64,
+    )
+    # Batch API
+    parser.add_argument(
+        "-b",
+        "--batch",
+        help="Run documents through the OpenAI Batch API",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     start = time.perf_counter()
@@ -67,12 +114,12 @@ if __name__ == "__main__":
 
     # Runs summary program on documents
     documents = pd.read_csv(input_documents_path)
-    tqdm.pandas(desc="Summarizing case documents")
-    summaries = documents.apply(
-        summary_helper,
-        model=summary_model,
+    summaries = run_summary_program(
+        documents=documents,
+        summary_model=summary_model,
         verbose=args.verbose,
-        axis=1,
+        concurrency=args.concurrency,
+        batch=args.batch,
     )
     summaries.to_csv(output_summaries_path, index=False)
 
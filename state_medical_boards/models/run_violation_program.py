@@ -8,77 +8,143 @@
 # allegations of particular violations 
 
 import argparse
+import dspy
 import os
 import pandas as pd
 import sys
 import time
-from tqdm import tqdm
+from typing import Sequence
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(project_root)
 
-from setup import configure_dspy, load_dspy_program
-from utils import truncate_text_by_max_tokens
-
-
-# Runs violation program on documents
-def violations_helper(row: pd.DataFrame, program) -> pd.DataFrame:
-
-    if row["textdata"] == "":
-        row["patient_mentioned"] = "empty"
-        row["fraud_case"] = "empty"
-        row["malpractice_case"] = "empty"
-        row["dea_case"] = "empty"
-        row["improper_opioid_prescription"] = "empty"
-        row["improper_drug_prescription"] = "empty"
-        row["unfit_to_practice"] = "empty"
-        row["bad_medical_records"] = "empty"
-        row["license_issues"] = "empty"
-        row["miscellaneous_violation"] = "empty"
-        row["other_state_action"] = "empty"
-        row["no_substantative_information"] = "empty"
-        row["proactive"] = "empty"
-
-        return row
-
-    try:
-        truncated_case_text = truncate_text_by_max_tokens(
-            text=row["textdata"], max_tokens=12000
+from setup import configure_dspy, create_lm, load_dspy_program, run_dspy_program
+from utils import truncate_texts_by_max_tokens_with_counts
+
+# Violation columns produced by the violation program
+violation_columns = [
+    "patient_mentioned",
+    "fraud_case",
+    "malpractice_case",
+    "dea_case",
+    "improper_opioid_prescription",
+    "improper_drug_prescription",
+    "unfit_to_practice",
+    "bad_medical_records",
+    "license_issues",
+    "miscellaneous_violation",
+    "other_state_action",
+    "no_substantive_information",
+    "proactive",
+]
+
+
+# Runs violation program on documents concurrently
+def run_violation_program(
+    documents: pd.DataFrame,
+    program,
+    program_version: str,
+    concurrency: int = 64,
+    batch: bool = False,
+    trivial_max_tokens: int = 200,
+    cheap_max_tokens: int = 1000,
+    cheap_model: str = "openai/gpt-4o-mini",
+    similarity_threshold: float | None = None,
+) -> pd.DataFrame:
+
+    # Finds empty documents
+    documents = documents.reset_index(drop=True)
+    empty = documents["textdata"].fillna("").eq("")
+
+    # Routes the remaining documents by length
+    texts, counts = truncate_texts_by_max_tokens_with_counts(
+        texts=documents.loc[~empty, "textdata"], max_tokens=12000
+    )
+    case_texts = pd.Series(texts, index=documents.index[~empty], dtype=object)
+    token_counts = pd.Series(counts, index=case_texts.index, dtype=int)
+    trivial = token_counts.index[token_counts < trivial_max_tokens]
+    short = token_counts.index[
+        (token_counts >= trivial_max_tokens) & (token_counts < cheap_max_tokens)
+    ]
+    long = token_counts.index[token_counts >= cheap_max_tokens]
+
+    # Marks empty and trivial documents
+    violations = pd.DataFrame(
+        "failed to process",
+        index=documents.index,
+        columns=violation_columns,
+        dtype=object,
+    )
+    violations.loc[empty, :] = "empty"
+    violations.loc[trivial, :] = 0
+    violations.loc[trivial, "no_substantive_information"] = 1
+
+    # Runs the cheap model on short documents and the main model on long ones
+    routes = [(short, create_lm(model=cheap_model)), (long, dspy.settings.lm)]
+    for index, lm in routes:
+        inputs = [{"case_document": case_text} for case_text in case_texts[index]]
+        with dspy.context(lm=lm):
+            responses = run_dspy_program(
+                program=program,
+                inputs=inputs,
+                program_version=f"{program_version}:{lm.model}",
+                concurrency=concurrency,
+                batch=batch,
+                similarity_threshold=similarity_threshold,
+                verbose=True,
+            )
+
+        # Marks failed documents
+        succeeded = [response is not None for response in responses]
+        responded = index[succeeded]
+        for failed_index in index.difference(responded):
+            print(f"Error processing document {failed_index}")
+
+        # Fills the violation columns of every processed document
+        violations.loc[responded, :] = violations_helper(
+            responses=[response for response in responses if response is not None],
+            index=responded,
         )
-        response = program(case_document=truncated_case_text)
-
-        row["patient_mentioned"] = response.patient_mentioned
-        row["fraud_case"] = response.fraud_case
-        row["malpractice_case"] = response.malpractice_case
-        row["dea_case"] = response.dea_case
-        row["improper_opioid_prescription"] = response.improper_opioid_prescription
-        row["improper_drug_prescription"] = response.improper_opioid_prescription
-        row["unfit_to_practice"] = response.unfit_to_practice
-        row["bad_medical_records"] = response.bad_medical_records
-        row["license_issues"] = response.license_issues
-        row["miscellaneous_violation"] = response.miscellaneous_violation
-        row["other_state_action"] = response.other_state_action
-        row["no_substantive_information"] = response.no_substantive_information
-        row["proactive"] = response.proactive
-
-    except Exception as e:
-        print(f"Error processing document {row.name}: {str(e)}")
-
-        row["patient_mentioned"] = "failed to process"
-        row["fraud_case"] = "failed to process"
-        row["malpractice_case"] = "failed to process"
-        row["dea_case"] = "failed to process"
-        row["improper_opioid_prescription"] = "failed to process"
-        row["improper_drug_prescription"] = "failed to process"
-        row["unfit_to_practice"] = "failed to process"
-        row["bad_medical_records"] = "failed to process"
-        row["license_issues"] = "failed to process"
-        row["miscellaneous_violation"] = "failed to process"
-        row["other_state_action"] = "failed to process"
-        row["no_substantative_information"] = "failed to process"
-        row["proactive"] = "failed to process"
-
-    return row
+
+    return pd.concat(objs=[documents, violations], axis=1)
+
+
+# Builds violation columns from violation program responses
+def violations_helper(responses: Sequence, index: pd.Index) -> pd.DataFrame:
+
+    violations = pd.DataFrame(
+        {
+            "patient_mentioned": [response.patient_mentioned for response in responses],
+            "fraud_case": [response.fraud_case for response in responses],
+            "malpractice_case": [response.malpractice_case for response in responses],
+            "dea_case": [response.dea_case for response in responses],
+            "improper_opioid_prescription": [
+                response.improper_opioid_prescription for response in responses
+            ],
+            "improper_drug_prescription": [
+                response.improper_drug_prescription for response in responses
+            ],
+            "unfit_to_practice": [response.unfit_to_practice for response in responses],
+            "bad_medical_records": [
+                response.bad_medical_records for response in responses
+            ],
+            "license_issues": [response.license_issues for response in responses],
+            "miscellaneous_violation": [
+                response.miscellaneous_violation for response in responses
+            ],
+            "other_state_action": [
+                response.other_state_action for response in responses
+            ],
+            "no_substantive_information": [
+                response.no_substantive_information for response in responses
+            ],
+            "proactive": [response.proactive for response in responses],
+        },
+        index=index,
+        dtype=object,
+    )
+
+    return violations
 
 
 if __name__ == "__main__":
@@ -91,6 +157,21 @@ if __name__ == "__main__":
         help="Increase violation program verbosity",
         action="store_true",
     )
+    # Concurrency
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="Number of documents processed concurrently",
+        type=int,
+        default=64,
+    )
+    # Batch API
+    parser.add_argument(
+        "-b",
+        "--batch",
+        help="Run documents through the OpenAI Batch API",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     start = time.perf_counter()
@@ -104,15 +185,18 @@ if __name__ == "__main__":
         print("Loading violation program")
     program_path = "../training/programs/violation/violation_program_v2.pkl"
     dspy = configure_dspy()
-    violation_program = load_dspy_program(dspy=dspy, program_path=program_path)
+    violation_program = load_dspy_program(
+        dspy=dspy, program_path=program_path, chain_of_thought=True
+    )  # NOTE v2 uses chain of thought, newer programs do not
 
     # Runs violation program on documents
     documents = pd.read_csv(input_documents_path)
-    tqdm.pandas(desc="Identifying violations")
-    violations = documents.progress_apply(
-        violations_helper,
+    violations = run_violation_program(
+        documents=documents,
         program=violation_program,
-        axis=1,
+        program_version=program_path,
+        concurrency=args.concurrency,
+        batch=args.batch,
     )
     if args.verbose:
         print(f"Saving violations output to {output_summaries_path}")
@@ -6,9 +6,21 @@
 # This file configures DSPY and helper functions
 # and defines DSPY modules 
 
+import asyncio
 from dotenv import load_dotenv
 import dspy
+import hashlib
+import io
+import json
+import numpy as np
+from openai import OpenAI
 import os
+import shelve
+import threading
+import time
+from typing import Sequence
+
+from utils import truncate_texts_by_max_tokens
 
 load_dotenv()
 
@@ -16,25 +28,342 @@ load_dotenv()
 # Configures DSPy
 def configure_dspy() -> dspy:
 
+    lm = create_lm(model=os.environ.get("OPENAI_MODEL"))
+    dspy.configure(lm=lm, adapter=PrefixCachingAdapter())
+
+    return dspy
+
+
+# Creates a DSPy language model
+def create_lm(model: str) -> dspy.LM:
+
     lm = dspy.LM(
-        model=os.environ.get("OPENAI_MODEL"),
+        model=model,
         organization=os.environ.get("OPENAI_ORG"),
         max_tokens=2048,
+        cache=True,
     )
-    dspy.configure(lm=lm)
 
-    return dspy
+    return lm
+
+
+# Renders prompts so that only the case document follows the cached prefix
+class PrefixCachingAdapter(dspy.ChatAdapter):
+    """Chat adapter that moves the static output requirements from the end of the
+    user message into the system message, so every call shares one long prefix.
+    Prompts are rendered once per signature and demos and reused for every
+    document."""
+
+    placeholder = "<<case document placeholder>>"
+    max_rendered = 128
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.rendered = {}
+        self.rendered_lock = threading.Lock()
+
+    def format(self, signature: dspy.Signature, demos: list, inputs: dict) -> list:
+
+        # Renders directly when more than the document varies between calls
+        if len(signature.input_fields) != 1:
+            return self.render(signature=signature, demos=demos, inputs=inputs)
+
+        # Renders the prompt once with a placeholder document
+        input_field = next(iter(signature.input_fields))
+        key = (signature, tuple(id(demo) for demo in demos))
+        with self.rendered_lock:
+            rendered = self.rendered.get(key)
+        if rendered is None:
+            messages = self.render(
+                signature=signature,
+                demos=demos,
+                inputs={input_field: self.placeholder},
+            )
+            # Keeps the demos alive so their ids stay unique while cached
+            rendered = (messages, demos)
+            with self.rendered_lock:
+                if key not in self.rendered and len(self.rendered) >= self.max_rendered:
+                    self.rendered.pop(next(iter(self.rendered)))
+                self.rendered[key] = rendered
+
+        # Fills the document into a copy of the rendered prompt
+        messages = [dict(message) for message in rendered[0]]
+        if self.placeholder not in messages[-1]["content"]:
+            return self.render(signature=signature, demos=demos, inputs=inputs)
+        before, _, after = messages[-1]["content"].rpartition(self.placeholder)
+        messages[-1]["content"] = before + str(inputs[input_field]) + after
+
+        return messages
+
+    def render(self, signature: dspy.Signature, demos: list, inputs: dict) -> list:
+
+        messages = super().format(signature=signature, demos=demos, inputs=inputs)
+
+        # Finds the end of the last input field in the final user message
+        request = messages[-1]["content"]
+        document = str(inputs[list(signature.input_fields)[-1]])
+        document_end = request.rfind(document)
+        if document_end == -1:
+            return messages
+        document_end += len(document)
+
+        # Moves everything after the document into the system message
+        requirements = request[document_end:].strip()
+        if requirements:
+            messages[0]["content"] += "\n\n" + requirements
+            messages[-1]["content"] = request[:document_end]
+
+        return messages
 
 
 # Loads saved DSPy program
-def load_dspy_program(dspy: dspy, program_path: str) -> dspy.Program:
+def load_dspy_program(
+    dspy: dspy, program_path: str, chain_of_thought: bool = False
+) -> dspy.Program:
 
-    violation_program = dspy.ChainOfThought(DoctorViolationModel)
+    # Programs up to v2 were trained with chain of thought reasoning
+    if chain_of_thought:
+        violation_program = dspy.ChainOfThought(DoctorViolationModel)
+    else:
+        violation_program = dspy.Predict(DoctorViolationModel)
     violation_program.load(path=program_path)
 
     return violation_program
 
 
+# Runs a DSPy program on many inputs, serving repeated inputs from a disk cache
+def run_dspy_program(
+    program: dspy.Program,
+    inputs: Sequence[dict],
+    program_version: str,
+    concurrency: int = 64,
+    batch: bool = False,
+    cache_path: str = "./.dspy_cache",
+    similarity_threshold: float | None = None,
+    verbose: bool = False,
+) -> Sequence[dspy.Prediction | None]:
+
+    with shelve.open(cache_path) as cache:
+
+        # Looks up every input in the cache
+        keys = [
+            response_cache_key(program_inputs, program_version)
+            for program_inputs in inputs
+        ]
+        responses = [
+            dspy.Prediction(**cache[key]) if key in cache else None for key in keys
+        ]
+        misses = [i for i, response in enumerate(responses) if response is None]
+        if verbose:
+            print(f"Found {len(inputs) - len(misses)} cached responses")
+
+        # Reuses the responses of near-duplicate inputs
+        if similarity_threshold is not None and misses:
+            embeddings = embed_inputs(inputs=[inputs[i] for i in misses])
+            embedding_key = f"embeddings:{program_version}"
+            cached_keys, cached_embeddings = cache.get(
+                embedding_key,
+                ([], np.empty((0, embeddings.shape[1]), dtype=np.float32)),
+            )
+            if cached_keys:
+                similarities = embeddings @ cached_embeddings.T
+                nearest = similarities.argmax(axis=1)
+                for row, i in enumerate(misses):
+                    if similarities[row, nearest[row]] >= similarity_threshold:
+                        responses[i] = dspy.Prediction(
+                            **cache[cached_keys[nearest[row]]]
+                        )
+            remaining = [row for row, i in enumerate(misses) if responses[i] is None]
+            if verbose:
+                print(f"Found {len(misses) - len(remaining)} similar responses")
+            misses = [misses[row] for row in remaining]
+            embeddings = embeddings[remaining]
+
+        # Runs the program on the remaining inputs
+        uncached_inputs = [inputs[i] for i in misses]
+        if batch:
+            results = run_dspy_batch(
+                program=program, inputs=uncached_inputs, verbose=verbose
+            )
+        else:
+            results = asyncio.run(
+                run_dspy_async(
+                    program=program, inputs=uncached_inputs, concurrency=concurrency
+                )
+            )
+
+        # Stores the new responses
+        for i, response in zip(misses, results):
+            responses[i] = response
+            if response is not None:
+                cache[keys[i]] = response.toDict()
+
+        # Stores the embeddings of the new responses
+        if similarity_threshold is not None and misses:
+            stored = [row for row, i in enumerate(misses) if responses[i] is not None]
+            cache[embedding_key] = (
+                cached_keys + [keys[misses[row]] for row in stored],
+                np.vstack([cached_embeddings, embeddings[stored]]),
+            )
+
+    return responses
+
+
+# Embeds program inputs as unit vectors
+def embed_inputs(
+    inputs: Sequence[dict],
+    model: str = "text-embedding-3-small",
+    batch_size: int = 16,
+) -> np.ndarray:
+
+    client = OpenAI(organization=os.environ.get("OPENAI_ORG"))
+
+    # Truncates each input to the embedding model's context window
+    texts = truncate_texts_by_max_tokens(
+        texts=[
+            "\n".join(str(value) for value in program_inputs.values())
+            for program_inputs in inputs
+        ],
+        max_tokens=8000,
+    )
+
+    # Embeds the texts in batches
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        response = client.embeddings.create(
+            model=model, input=texts[i : i + batch_size]
+        )
+        embeddings.extend(item.embedding for item in response.data)
+    embeddings = np.array(embeddings, dtype=np.float32)
+
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+# Runs a DSPy program on many inputs concurrently on one event loop
+async def run_dspy_async(
+    program: dspy.Program, inputs: Sequence[dict], concurrency: int
+) -> Sequence[dspy.Prediction | None]:
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(program_inputs: dict) -> dspy.Prediction | None:
+
+        async with semaphore:
+            try:
+                return await program.acall(**program_inputs)
+            except Exception as e:
+                print(f"Error running program: {str(e)}")
+                return None
+
+    return await asyncio.gather(*(run_one(program_inputs) for program_inputs in inputs))
+
+
+# Hashes program inputs and version into a response cache key
+def response_cache_key(inputs: dict, program_version: str) -> str:
+
+    payload = json.dumps([program_version, inputs], sort_keys=True)
+
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+# Runs a DSPy program on many inputs through the OpenAI Batch API
+def run_dspy_batch(
+    program: dspy.Program,
+    inputs: Sequence[dict],
+    poll_interval: int = 60,
+    max_batch_requests: int = 50000,
+    max_batch_bytes: int = 190 * 2**20,
+    verbose: bool = False,
+) -> Sequence[dspy.Prediction | None]:
+
+    lm = dspy.settings.lm
+    adapter = dspy.settings.adapter or dspy.ChatAdapter()
+    predictor = program.predictors()[0]
+    client = OpenAI(organization=os.environ.get("OPENAI_ORG"))
+
+    # Renders each prompt exactly as the program would send it, splitting the
+    # requests into files within the Batch API input limits
+    settings = {
+        key: lm.kwargs[key] for key in ("temperature", "max_tokens") if key in lm.kwargs
+    }
+    batch_files = []
+    requests = io.BytesIO()
+    num_requests = 0
+    for i, program_inputs in enumerate(inputs):
+        messages = adapter.format(
+            signature=predictor.signature,
+            demos=predictor.demos,
+            inputs=program_inputs,
+        )
+        request = {
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": lm.model.split("/")[-1],
+                "messages": messages,
+                **settings,
+            },
+        }
+        line = (json.dumps(request) + "\n").encode()
+        if num_requests and (
+            num_requests == max_batch_requests
+            or requests.tell() + len(line) > max_batch_bytes
+        ):
+            batch_files.append(requests.getvalue())
+            requests = io.BytesIO()
+            num_requests = 0
+        requests.write(line)
+        num_requests += 1
+    if num_requests:
+        batch_files.append(requests.getvalue())
+
+    # Submits the batches
+    batches = []
+    for requests in batch_files:
+        batch_file = client.files.create(
+            file=("batch.jsonl", requests), purpose="batch"
+        )
+        batches.append(
+            client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+        )
+    if verbose:
+        print(f"Submitted {len(batches)} batches with {len(inputs)} requests")
+
+    # Waits for every batch to finish
+    finished = ("completed", "failed", "expired", "cancelled")
+    while any(batch.status not in finished for batch in batches):
+        time.sleep(poll_interval)
+        batches = [
+            batch if batch.status in finished else client.batches.retrieve(batch.id)
+            for batch in batches
+        ]
+    if verbose:
+        for batch in batches:
+            print(f"Batch {batch.id} finished with status {batch.status}")
+
+    # Parses each completion with the program's output adapter
+    predictions = [None] * len(inputs)
+    for batch in batches:
+        if batch.output_file_id is None:
+            continue
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            result = json.loads(line)
+            try:
+                completion = result["response"]["body"]["choices"][0]["message"]
+                outputs = adapter.parse(predictor.signature, completion["content"])
+                predictions[int(result["custom_id"])] = dspy.Prediction(**outputs)
+            except Exception as e:
+                print(f"Error parsing batch result {result['custom_id']}: {str(e)}")
+
+    return predictions
+
+
 # Defines the input and output structure of the violation DSPy model
 class DoctorViolationModel(dspy.Signature):
     """Extract boolean information regarding the contents of a medical board case.
@@ -85,25 +414,24 @@ class DoctorViolationModel(dspy.Signature):
     )
 
 
+# Output fields scored by the doctor violation metric
+violation_fields = tuple(DoctorViolationModel.output_fields)
+
+
 # Evaluation metric for the doctor violation program.
-def doctor_violation_metric(example, pred, trace=None) -> int:
+def doctor_violation_metric(
+    example, pred, trace=None, min_score: int | None = None
+) -> int:
 
     score = 0
-    score += int(pred.patient_mentioned == example.patient_mentioned)
-    score += int(pred.fraud_case == example.fraud_case)
-    score += int(pred.malpractice_case == example.malpractice_case)
-    score += int(pred.dea_case == example.dea_case)
-    score += int(
-        pred.improper_opioid_prescription == example.improper_opioid_prescription
-    )
-    score += int(pred.improper_drug_prescription == example.improper_drug_prescription)
-    score += int(pred.unfit_to_practice == example.unfit_to_practice)
-    score += int(pred.bad_medical_records == example.bad_medical_records)
-    score += int(pred.license_issues == example.license_issues)
-    score += int(pred.miscellaneous_violation == example.miscellaneous_violation)
-    score += int(pred.other_state_action == example.other_state_action)
-    score += int(pred.no_substantive_information == example.no_substantive_information)
-    score += int(pred.proactive == example.proactive)
+    remaining = len(violation_fields)
+    for field in violation_fields:
+        score += pred.get(field) == example.get(field)
+        remaining -= 1
+
+        # Stops once the remaining fields can no longer reach min_score
+        if min_score is not None and score + remaining < min_score:
+            break
 
     return score
 
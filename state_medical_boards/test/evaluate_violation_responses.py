@@ -9,10 +9,28 @@
 # on testing data 
 
 import argparse
-import matplotlib.pyplot as plt
+import concurrent.futures
+import matplotlib
+from matplotlib.figure import Figure
+import numpy as np
+import os
 import pandas as pd
 import seaborn as sns
-from sklearn.metrics import confusion_matrix
+from typing import Sequence
+
+matplotlib.use("Agg")
+
+
+# Loads responses as strings, skipping unnecessary columns
+def load_responses(responses_path: str) -> pd.DataFrame:
+
+    responses = pd.read_csv(
+        responses_path,
+        usecols=lambda column: column not in {"iddoc", "year", "state"},
+        dtype=str,
+    )
+
+    return responses
 
 
 # Cleans responses
@@ -22,14 +40,61 @@ def clean_responses(responses: pd.DataFrame) -> pd.DataFrame:
     responses = responses[~responses["textdata"].isna()]
 
     # Drops unnecessary columns
-    responses = responses.drop(columns=["iddoc", "textdata", "year", "state"])
+    responses = responses.drop(columns=["textdata"])
 
-    # Converts all columns to str dtype
+    # Converts missing values to str
     responses = responses.astype(str)
 
     return responses
 
 
+# Creates confusion matrices for every column in one pass
+def confusion_matrices(
+    y_true: pd.DataFrame, y_pred: pd.DataFrame, labels: Sequence[str]
+) -> np.ndarray:
+
+    # Encodes responses as label positions, with -1 for unknown responses
+    true_codes = pd.Categorical(y_true.to_numpy().ravel(), categories=labels).codes
+    pred_codes = pd.Categorical(
+        y_pred[y_true.columns].to_numpy().ravel(), categories=labels
+    ).codes
+
+    # Counts every (column, true, predicted) combination at once
+    num_columns = y_true.shape[1]
+    num_labels = len(labels)
+    columns = np.tile(np.arange(num_columns), len(y_true))
+    known = (true_codes >= 0) & (pred_codes >= 0)
+    cells = (
+        columns[known] * num_labels + true_codes[known]
+    ) * num_labels + pred_codes[known]
+    counts = np.bincount(cells, minlength=num_columns * num_labels * num_labels)
+
+    return counts.reshape(num_columns, num_labels, num_labels)
+
+
+# Plots and saves a confusion matrix
+def plot_confusion_matrix(
+    violation: str, cm: np.ndarray, labels: Sequence[str], figure_path: str
+) -> None:
+
+    # Builds the figure without pyplot so that threads do not share state
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
+    sns.heatmap(
+        cm,
+        ax=ax,
+        annot=True,
+        fmt="d",
+        cmap="Blues",
+        xticklabels=labels,
+        yticklabels=labels,
+    )
+    ax.set_xlabel("Predicted")
+    ax.set_ylabel("True")
+    ax.set_title(f"{violation} Confusion Matrix")
+    fig.savefig(figure_path)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -43,12 +108,12 @@ if __name__ == "__main__":
 
     # Loads responses
     true_response_path = "./violation/true/seed_2_50_violations_true_bool.csv"
-    y_true = pd.read_csv(true_response_path)
+    y_true = load_responses(responses_path=true_response_path)
 
     pred_response_path = (
         f"./violation/pred/seed_2_50_violations_pred_v{args.version}.csv"
     )
-    y_pred = pd.read_csv(pred_response_path)
+    y_pred = load_responses(responses_path=pred_response_path)
 
     # Cleans responses
     y_true = clean_responses(responses=y_true)
@@ -56,26 +121,21 @@ if __name__ == "__main__":
 
     # Creates confusion matrices for each column
     violations = y_true.columns
-    for violation in violations:
-        cm = confusion_matrix(
-            y_true=y_true[violation].tolist(),
-            y_pred=y_pred[violation].tolist(),
-            labels=["1", "0", "-1"],
-        )
-
-        plt.figure(figsize=(8, 6))
-        sns.heatmap(
-            cm,
-            annot=True,
-            fmt="d",
-            cmap="Blues",
-            xticklabels=["1", "0", "-1"],
-            yticklabels=["1", "0", "-1"],
-        )
-        plt.xlabel("Predicted")
-        plt.ylabel("True")
-        plt.title(f"{violation} Confusion Matrix")
-        plt.savefig(
-            f"./violation/v{args.version}/figures/{violation}_confusion_matrix.png"
-        )
-        plt.close()
+    labels = ["1", "0", "-1"]
+    cms = confusion_matrices(y_true=y_true, y_pred=y_pred, labels=labels)
+
+    # Saves the plots concurrently
+    figures_path = f"./violation/v{args.version}/figures"
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            executor.submit(
+                plot_confusion_matrix,
+                violation=violation,
+                cm=cm,
+                labels=labels,
+                figure_path=f"{figures_path}/{violation}_confusion_matrix.png",
+            )
+            for violation, cm in zip(violations, cms)
+        ]
+        for future in futures:
+            future.result()
@@ -12,18 +12,19 @@ import contextlib
 from dspy import Example, Evaluate, Program, SIMBA
 from dspy.teleprompt import BootstrapFewShotWithRandomSearch, MIPROv2
 import io
+import math
+import numpy as np
 import os
 import pandas as pd
 import sys
 import time
-from tqdm import tqdm
 from typing import Sequence
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(project_root)
 
 from setup import configure_dspy, doctor_violation_metric, DoctorViolationModel
-from utils import truncate_text_by_max_tokens
+from utils import count_tokens_batch, truncate_texts_by_max_tokens
 
 
 # Prepares the DSPy training data
@@ -39,34 +40,24 @@ def prepare_training_data(
     training_data = pd.concat(objs=[training_documents, training_responses], axis=1)
     training_data.drop(columns=["iddoc", "year", "state"], inplace=True)
     training_data.dropna(subset=["textdata"], inplace=True)
-    tqdm.pandas(desc="Truncating training data")
-    training_data["textdata"] = training_data["textdata"].progress_apply(
-        lambda case_text: truncate_text_by_max_tokens(text=case_text, max_tokens=500)
+    training_data["textdata"] = truncate_texts_by_max_tokens(
+        texts=training_data["textdata"], max_tokens=500
     )
 
     if verbose:
         print(f"Training columns: {list(training_data.columns)}")
 
-    trainset = []
-    for row in training_data.itertuples():
-        trainset.append(
-            Example(
-                case_document=row.textdata,
-                patient_mentioned=row.patient_mentioned,
-                fraud_case=row.fraud_case,
-                malpractice_case=row.malpractice_case,
-                dea_case=row.dea_case,
-                improper_opioid_prescription=row.improper_opioid_prescription,
-                improper_drug_prescription=row.improper_drug_prescription,
-                unfit_to_practice=row.unfit_to_practice,
-                bad_medical_records=row.bad_medical_records,
-                license_issues=row.license_issues,
-                miscellaneous_violation=row.miscellaneous_violation,
-                other_state_action=row.other_state_action,
-                no_substantive_information=row.no_substantive_information,
-                proactive=row.proactive,
-            ).with_inputs(training_inputs)
-        )
+    # Builds the training examples from the label columns
+    label_columns = list(DoctorViolationModel.output_fields)
+    columns = [
+        training_data[column].tolist() for column in ["textdata", *label_columns]
+    ]
+    trainset = [
+        Example(
+            case_document=case_document, **dict(zip(label_columns, labels))
+        ).with_inputs(training_inputs)
+        for case_document, *labels in zip(*columns)
+    ]
 
     length = len(trainset)
     cutoff = int(0.8 * length)
@@ -77,11 +68,15 @@ def prepare_training_data(
 
 
 def optimize_program(
-    trainset: Sequence[Example], optimizer: str, save_path: str, verbose: bool
+    trainset: Sequence[Example],
+    optimizer: str,
+    save_path: str,
+    verbose: bool,
+    num_threads: int = 8,
 ) -> Program:
 
     dspy = configure_dspy()
-    violation_program = dspy.ChainOfThought(DoctorViolationModel)
+    violation_program = dspy.Predict(DoctorViolationModel)
 
     # Saves baseline prompt
     violation_program(case_document="Placeholder for baseline prompt")
@@ -104,6 +99,7 @@ def optimize_program(
         teleprompter = MIPROv2(
             metric=doctor_violation_metric,
             auto="light",
+            num_threads=num_threads,
         )
         optimized_violation_program = teleprompter.compile(
             violation_program.deepcopy(),
@@ -122,6 +118,7 @@ def optimize_program(
             max_steps=1,
             max_demos=0,
             demo_input_field_maxlen=500,
+            num_threads=num_threads,
         )
         optimized_violation_program = simba.compile(
             violation_program, trainset=trainset, seed=0
@@ -138,14 +135,11 @@ def optimize_program(
     # Evaluates optimized program
     if verbose:
         print(f"Evaluating optimized program...")
-    evaluate = Evaluate(
+    evaluate_program(
+        program=optimized_violation_program,
         devset=devset[:],
-        metric=doctor_violation_metric,
-        num_threads=8,
-        display_progress=True,
-        display_table=False,
+        num_threads=num_threads,
     )
-    evaluate(program=optimized_violation_program, devset=devset[:])
 
     # Saves optimized prompt
     violation_program(case_document="Placeholder for optimized prompt.")
@@ -159,6 +153,40 @@ def optimize_program(
     return optimized_violation_program
 
 
+# Evaluates a program on bins of similarly sized examples
+def evaluate_program(
+    program: Program,
+    devset: Sequence[Example],
+    num_bins: int = 3,
+    num_threads: int = 8,
+) -> float:
+
+    if not devset:
+        raise ValueError("Cannot evaluate a program on an empty devset")
+
+    # Sorts the examples by token count
+    token_counts = count_tokens_batch([example.case_document for example in devset])
+    ordered = [devset[i] for i in np.argsort(token_counts, kind="stable")]
+
+    # Evaluates each bin separately so short examples never wait on long ones
+    bin_size = math.ceil(len(ordered) / num_bins)
+    scores = []
+    for i in range(0, len(ordered), bin_size):
+        bin_devset = ordered[i : i + bin_size]
+        evaluate = Evaluate(
+            devset=bin_devset,
+            metric=doctor_violation_metric,
+            num_threads=num_threads,
+            display_progress=True,
+            display_table=False,
+        )
+        scores.append((evaluate(program=program), len(bin_devset)))
+
+    score = sum(bin_score * size for bin_score, size in scores) / len(devset)
+
+    return score
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -172,6 +200,15 @@ if __name__ == "__main__":
         help="Specify the optimizer (bfsrs, miprov2, simba)",
     )
 
+    # Rate limit
+    parser.add_argument(
+        "-r",
+        "--requests-per-minute",
+        type=int,
+        default=500,
+        help="Provider request limit used to size the optimizer thread pool",
+    )
+
     # Verbosity
     parser.add_argument(
         "-v", "--verbose", help="Increase training verbosity", action="store_true"
@@ -200,12 +237,16 @@ if __name__ == "__main__":
         verbose=args.verbose,
     )
 
+    # Sizes the thread pool to the rate limit, assuming about 5 seconds per call
+    num_threads = min(64, max(1, args.requests_per_minute * 5 // 60))
+
     # Optimizes the DSPy program
     optimized_violation_program = optimize_program(
         trainset=trainset,
         optimizer=args.optimizer,
         save_path="./programs/violation/violation_program_v3.pkl",
         verbose=args.verbose,
+        num_threads=num_threads,
     )
 
     finish = time.perf_counter()
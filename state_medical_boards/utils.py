@@ -6,15 +6,70 @@
 # This file defines helper functions
 # for the code base 
 
+import concurrent.futures
 from dotenv import load_dotenv
+import functools
+import math
 import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import tiktoken
+from tiktoken_ext.openai_public import ENCODING_CONSTRUCTORS
 from typing import Sequence
 
 load_dotenv()
 
+# Tokenizer encoding, read once at import
+encoding_name = os.getenv("OPENAI_MODEL_ENCODING")
+
+# Truncation encodes at most this many characters per token up front, and
+# trusts the result only with extra tokens to spare at the cut
+truncation_chars_per_token = 8
+truncation_margin_tokens = 64
+
+# Texts longer than this many characters are never kept in the token cache
+max_cached_text_length = 1 << 14
+
+
+# Samples rows from a CSV file without loading the whole file
+def reservoir_sample_csv(
+    path: str, num_samples: int, seed: int, chunksize: int = 2**16
+) -> tuple[pd.DataFrame, np.ndarray]:
+
+    rng = np.random.default_rng(seed)
+    reservoir = None
+    sample_indices = np.empty(num_samples, dtype=np.int64)
+    num_rows = 0
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        positions = np.arange(num_rows, num_rows + len(chunk))
+        num_rows += len(chunk)
+
+        # Fills the empty slots, then replaces slots with decreasing probability
+        slots = np.where(
+            positions < num_samples, positions, rng.integers(0, positions + 1)
+        )
+        rows = np.flatnonzero(slots < num_samples)
+        slots = slots[rows]
+
+        # Keeps only the last row assigned to each slot
+        last = len(slots) - 1 - np.unique(slots[::-1], return_index=True)[1]
+        slots, rows = slots[last], rows[last]
+
+        chunk_sample = chunk.iloc[rows].set_axis(slots)
+        reservoir = (
+            chunk_sample
+            if reservoir is None
+            else pd.concat([reservoir.drop(index=slots, errors="ignore"), chunk_sample])
+        )
+        sample_indices[slots] = positions[rows]
+
+    if num_rows < num_samples:
+        raise ValueError(f"Cannot sample {num_samples} rows from {num_rows} rows")
+
+    return reservoir.sort_index().reset_index(drop=True), sample_indices
+
 
 # Samples random documents
 def sample_random_documents(
@@ -25,83 +80,438 @@ def sample_random_documents(
     verbose: bool,
 ) -> None:
 
-    df = pd.read_csv(input_documents_path)
-    np.random.seed(seed)
-    sample_indices = np.random.choice(len(df), size=num_samples, replace=False)
-
-    sample = df.iloc[sample_indices]
-    sample.to_csv(output_sample_documents_path, index=False)
+    # Samples the documents in a single streaming pass
+    sample, sample_indices = reservoir_sample_csv(
+        path=input_documents_path, num_samples=num_samples, seed=seed
+    )
 
-    documents = sample["textdata"]
+    # Writes the sample with the multithreaded Arrow CSV writer
+    pacsv.write_csv(
+        pa.Table.from_pandas(sample, preserve_index=False),
+        output_sample_documents_path,
+    )
 
+    # Previews the first document instead of printing every one
     if verbose:
+        documents = sample["textdata"]
         print("\nSample indices:", sample_indices)
-        print("\nSample documents:", documents.values)
+        if len(documents):
+            print(
+                f"\nSample documents: {len(documents)} rows,",
+                f"first={str(documents.iloc[0])[:200]!r}",
+            )
+        else:
+            print("\nSample documents: 0 rows")
+
+
+# Loads each tokenizer once and reuses it for every call
+@functools.lru_cache(maxsize=4)
+def get_encoding(name: str = encoding_name) -> tiktoken.Encoding:
+
+    encoding = tiktoken.get_encoding(name)
+
+    return encoding
+
+
+# Loads the tokenizer ahead of the first real call
+def prewarm_encoding() -> None:
+
+    # Reads the BPE file into TIKTOKEN_CACHE_DIR if it is not cached yet
+    get_encoding().encode_ordinary("")
+
+
+# Remembers the tokens of recently tokenized texts
+@functools.lru_cache(maxsize=256)
+def encode_cached(text: str) -> tuple[int, ...]:
+
+    return tuple(get_encoding().encode_ordinary(text))
 
 
 # Tokenizes text
-def tokenize_text(text: str) -> str:
+def tokenize_text(text: str) -> list[int]:
 
-    encoding = tiktoken.get_encoding(os.getenv("OPENAI_MODEL_ENCODING"))
-    tokenized_text = encoding.encode(text)
+    # Skips the cache for large texts
+    if len(text) > max_cached_text_length:
+        return get_encoding().encode_ordinary(text)
+
+    tokenized_text = list(encode_cached(text))
 
     return tokenized_text
 
 
+# Tokenizes many texts at once across threads
+def tokenize_texts(texts: Sequence[str]) -> Sequence[Sequence[int]]:
+
+    tokenized_texts = get_encoding().encode_ordinary_batch(
+        list(texts), num_threads=os.cpu_count()
+    )
+
+    return tokenized_texts
+
+
+# Shards batch tokenization across independent copies of the encoding
+class TokenizerPool:
+    """Independent copies of the configured encoding that split large encode and
+    decode batches between them, so no single encoding serves every thread.
+    Small batches go to one encoding. By default there is one shard per 32
+    cores."""
+
+    def __init__(
+        self,
+        name: str = encoding_name,
+        shards: int | None = None,
+        min_batch_size: int = 1024,
+    ):
+
+        num_cpus = os.cpu_count() or 1
+        shards = shards or max(1, num_cpus // 32)
+
+        # Builds every other shard from the encoding's public constructor so it
+        # owns its own core, sharing the one encoding for names without one
+        if name in ENCODING_CONSTRUCTORS:
+            copies = [
+                tiktoken.Encoding(**ENCODING_CONSTRUCTORS[name]())
+                for _ in range(shards - 1)
+            ]
+        else:
+            copies = [get_encoding(name)] * (shards - 1)
+        self.encodings = [get_encoding(name)] + copies
+        self.min_batch_size = min_batch_size
+        self.threads_per_shard = max(1, num_cpus // shards)
+
+    # Runs a batch method of the encodings over slices of the items
+    def map(self, method: str, items: Sequence) -> list:
+
+        items = list(items)
+        if len(self.encodings) == 1 or len(items) < self.min_batch_size:
+            return getattr(self.encodings[0], method)(
+                items, num_threads=os.cpu_count()
+            )
+
+        shard_size = math.ceil(len(items) / len(self.encodings))
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.encodings)
+        ) as executor:
+            shards = executor.map(
+                lambda encoding, i: getattr(encoding, method)(
+                    items[i : i + shard_size], num_threads=self.threads_per_shard
+                ),
+                self.encodings,
+                range(0, len(items), shard_size),
+            )
+
+        return [result for shard in shards for result in shard]
+
+    def encode_ordinary_batch(self, texts: Sequence[str]) -> list[list[int]]:
+
+        return self.map(method="encode_ordinary_batch", items=texts)
+
+    def decode_batch(self, batch: Sequence[Sequence[int]]) -> list[str]:
+
+        return self.map(method="decode_batch", items=batch)
+
+
+# Builds each tokenizer pool once and reuses it for every call
+@functools.lru_cache(maxsize=4)
+def get_tokenizer_pool(
+    name: str = encoding_name, shards: int | None = None
+) -> TokenizerPool:
+
+    return TokenizerPool(name=name, shards=shards)
+
+
+# Loads a HuggingFace tokenizer once and copies it for every shard
+@functools.lru_cache(maxsize=4)
+def get_hf_tokenizers(model_name: str, shards: int) -> tuple:
+
+    from tokenizers import Tokenizer
+
+    tokenizer = Tokenizer.from_pretrained(model_name)
+    serialized = tokenizer.to_str()
+
+    return (tokenizer,) + tuple(
+        Tokenizer.from_str(serialized) for _ in range(shards - 1)
+    )
+
+
+# Tokenizes a large corpus with tiktoken or a HuggingFace tokenizer
+def tokenize_corpus(
+    texts: Sequence[str],
+    backend: str = "tiktoken",
+    model_name: str | None = None,
+    shards: int | None = None,
+) -> Sequence[Sequence[int]]:
+
+    texts = list(texts)
+    if backend == "tiktoken":
+
+        return get_tokenizer_pool(shards=shards).encode_ordinary_batch(texts)
+    elif backend == "hf":
+        if model_name is None:
+            raise ValueError("model_name is required for the hf tokenizer backend")
+        shards = shards or max(1, (os.cpu_count() or 1) // 4)
+
+        # Gives every shard its own tokenizer to avoid lock contention
+        shard_size = max(1, math.ceil(len(texts) / shards))
+        tokenizers = get_hf_tokenizers(model_name=model_name, shards=shards)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=shards) as executor:
+            encoded_shards = executor.map(
+                lambda tokenizer, i: tokenizer.encode_batch(
+                    texts[i : i + shard_size], add_special_tokens=False
+                ),
+                tokenizers,
+                range(0, len(texts), shard_size),
+            )
+
+        return [encoded.ids for shard in encoded_shards for encoded in shard]
+    else:
+        raise ValueError(f"Unknown tokenizer backend: {backend}")
+
+
 # Detokenizes text
-def detokenize_text(tokenized_text: str) -> str:
+def detokenize_text(tokenized_text: Sequence[int]) -> str:
 
-    encoding = tiktoken.get_encoding(os.getenv("OPENAI_MODEL_ENCODING"))
-    detokenized_text = encoding.decode(tokenized_text)
+    detokenized_text = get_encoding().decode(tokenized_text)
 
     return detokenized_text
 
 
-# Filters text longer than a maximum number of tokens
-def filter_text_by_max_tokens(text: str, max_tokens: int) -> str | None:
+# Checks whether text is too short to exceed a maximum number of tokens
+def fits_max_tokens(text: str, max_tokens: int) -> bool:
 
-    # Encodes the case text
-    encoded_text = tokenize_text(text)
+    # Every token covers at least one UTF-8 byte
+    num_bytes = len(text) if text.isascii() else len(text.encode("utf-8"))
 
-    if len(encoded_text) > max_tokens:
+    return num_bytes <= max_tokens
+
+
+# Encodes enough of the text to compare it with a maximum number of tokens
+def encode_for_max_tokens(text: str, max_tokens: int) -> list[int]:
+
+    encoding = get_encoding()
+
+    # Encodes only the start of the text when that is enough to decide, without
+    # filling the token cache with one-off prefixes
+    max_chars = max_tokens * truncation_chars_per_token
+    encoded_text = encoding.encode_ordinary(text[:max_chars])
+    if (
+        len(text) > max_chars
+        and len(encoded_text) <= max_tokens + truncation_margin_tokens
+    ):
+        encoded_text = encoding.encode_ordinary(text)
+
+    return encoded_text
+
+
+# Encodes enough of many texts to compare them with a maximum number of tokens
+def encode_texts_for_max_tokens(
+    texts: Sequence[str], max_tokens: int
+) -> list[list[int]]:
+
+    # Encodes only the start of every text first
+    max_chars = max_tokens * truncation_chars_per_token
+    encoded_texts = tokenize_texts([text[:max_chars] for text in texts])
+
+    # Re-encodes in full the texts whose start was too short to decide
+    retried = [
+        i
+        for i, (text, encoded_text) in enumerate(zip(texts, encoded_texts))
+        if len(text) > max_chars
+        and len(encoded_text) <= max_tokens + truncation_margin_tokens
+    ]
+    retried_texts = tokenize_texts([texts[i] for i in retried])
+    for i, encoded_text in zip(retried, retried_texts):
+        encoded_texts[i] = encoded_text
+
+    return encoded_texts
+
+
+# Filters or truncates text to fit a maximum number of tokens in one pass
+def normalize_text(text: str, max_tokens: int, mode: str = "truncate") -> str | None:
+
+    if mode not in ("filter", "truncate"):
+        raise ValueError(f"Unknown normalization mode: {mode}")
+
+    # Keeps short text without encoding it
+    if fits_max_tokens(text, max_tokens):
+        return text
+
+    encoded_text = encode_for_max_tokens(text=text, max_tokens=max_tokens)
+
+    if len(encoded_text) <= max_tokens:
+
+        return text
+    elif mode == "filter":
 
         return None
     else:
 
-        return text
+        return detokenize_text(encoded_text[:max_tokens])
+
+
+# Filters or truncates many texts at once across threads
+def normalize_texts(
+    texts: Sequence[str], max_tokens: int, mode: str = "truncate"
+) -> Sequence[str | None]:
+
+    if mode not in ("filter", "truncate"):
+        raise ValueError(f"Unknown normalization mode: {mode}")
+
+    # Encodes only the texts that could be too long
+    texts = list(texts)
+    candidates = [
+        i for i, text in enumerate(texts) if not fits_max_tokens(text, max_tokens)
+    ]
+    encoded_texts = encode_texts_for_max_tokens(
+        texts=[texts[i] for i in candidates], max_tokens=max_tokens
+    )
+
+    # Finds the texts over the limit
+    exceeded = [
+        (i, encoded_text[:max_tokens])
+        for i, encoded_text in zip(candidates, encoded_texts)
+        if len(encoded_text) > max_tokens
+    ]
+
+    # Drops or truncates them
+    if mode == "filter":
+        for i, _ in exceeded:
+            texts[i] = None
+    else:
+        truncated_texts = get_encoding().decode_batch(
+            [encoded_text for _, encoded_text in exceeded],
+            num_threads=os.cpu_count(),
+        )
+        for (i, _), truncated_text in zip(exceeded, truncated_texts):
+            texts[i] = truncated_text
+
+    return texts
+
+
+# Filters text longer than a maximum number of tokens
+def filter_text_by_max_tokens(text: str, max_tokens: int) -> str | None:
+
+    return normalize_text(text=text, max_tokens=max_tokens, mode="filter")
+
+
+# Filters many texts longer than a maximum number of tokens at once
+def filter_texts_by_max_tokens(
+    texts: Sequence[str], max_tokens: int
+) -> Sequence[str | None]:
+
+    return normalize_texts(texts=texts, max_tokens=max_tokens, mode="filter")
 
 
 # Truncates text to fit a maximum number of tokens
 def truncate_text_by_max_tokens(text: str, max_tokens: int) -> str:
 
-    # Encodes text
-    encoded_text = tokenize_text(text)
+    return normalize_text(text=text, max_tokens=max_tokens, mode="truncate")
+
+
+# Truncates text to fit a maximum number of tokens and returns its tokens
+def truncate_text_by_max_tokens_with_tokens(
+    text: str, max_tokens: int
+) -> tuple[str, list[int]]:
+
+    encoded_text = encode_for_max_tokens(text=text, max_tokens=max_tokens)
 
     # Truncates text as necessary
     if len(encoded_text) > max_tokens:
         truncated_encoded_text = encoded_text[:max_tokens]
         truncated_text = detokenize_text(truncated_encoded_text)
 
-        return truncated_text
+        return truncated_text, truncated_encoded_text
     else:
 
-        return text
+        return text, encoded_text
+
+
+# Truncates many texts at once across threads
+def truncate_texts_by_max_tokens(
+    texts: Sequence[str], max_tokens: int
+) -> Sequence[str]:
+
+    return normalize_texts(texts=texts, max_tokens=max_tokens, mode="truncate")
+
+
+# Truncates many texts at once and counts the tokens each one keeps
+def truncate_texts_by_max_tokens_with_counts(
+    texts: Sequence[str], max_tokens: int
+) -> tuple[list[str], list[int]]:
+
+    # Encodes every text once, since each one needs a token count
+    texts = list(texts)
+    encoded_texts = encode_texts_for_max_tokens(texts=texts, max_tokens=max_tokens)
+    token_counts = [
+        min(len(encoded_text), max_tokens) for encoded_text in encoded_texts
+    ]
+
+    # Truncates texts as necessary
+    truncated = [
+        i
+        for i, encoded_text in enumerate(encoded_texts)
+        if len(encoded_text) > max_tokens
+    ]
+    truncated_texts = get_encoding().decode_batch(
+        [encoded_texts[i][:max_tokens] for i in truncated],
+        num_threads=os.cpu_count(),
+    )
+    for i, truncated_text in zip(truncated, truncated_texts):
+        texts[i] = truncated_text
+
+    return texts, token_counts
 
 
 # Chunks text
 def chunk_text(text: str, chunk_size: int = 2500) -> Sequence[str]:
 
+    encoding = get_encoding()
+
     # Encodes the text
-    encoded_text = tokenize_text(text)
+    encoded_text = encoding.encode_ordinary(text)
 
-    # Chunks the text
-    chunks = []
-    for i in range(0, len(encoded_text), chunk_size):
-        chunks.append(detokenize_text(encoded_text[i : i + chunk_size]))
+    # Decodes every chunk in one batch
+    chunks = encoding.decode_batch(
+        [
+            encoded_text[i : i + chunk_size]
+            for i in range(0, len(encoded_text), chunk_size)
+        ],
+        num_threads=os.cpu_count(),
+    )
 
     return chunks
 
 
+# Chunks many texts at once across threads
+def chunk_texts(
+    texts: Sequence[str], chunk_size: int = 2500
+) -> Sequence[Sequence[str]]:
+
+    encoding = get_encoding()
+
+    # Encodes the texts
+    encoded_texts = tokenize_texts(texts)
+
+    # Chunks the texts
+    encoded_chunks = [
+        [
+            encoded_text[i : i + chunk_size]
+            for i in range(0, len(encoded_text), chunk_size)
+        ]
+        for encoded_text in encoded_texts
+    ]
+
+    # Decodes every chunk in one batch
+    decoded_chunks = iter(
+        encoding.decode_batch(
+            [chunk for chunks in encoded_chunks for chunk in chunks],
+            num_threads=os.cpu_count(),
+        )
+    )
+
+    return [[next(decoded_chunks) for _ in chunks] for chunks in encoded_chunks]
+
+
 # Counts number of tokens in text
 def count_tokens(text: str) -> int:
 
@@ -109,3 +519,25 @@ def count_tokens(text: str) -> int:
     encoded_text = tokenize_text(text)
 
     return len(encoded_text)
+
+
+# Checks whether text has at most a number of tokens
+def count_tokens_le(text: str, threshold: int) -> bool:
+
+    # Accepts short text without encoding it
+    if fits_max_tokens(text, threshold):
+        return True
+
+    return count_tokens(text) <= threshold
+
+
+# Counts number of tokens in many texts at once
+def count_tokens_batch(texts: Sequence[str], batch_size: int = 256) -> Sequence[int]:
+
+    # Encodes a batch at a time so only one batch of token lists is alive
+    texts = list(texts)
+    token_counts = []
+    for i in range(0, len(texts), batch_size):
+        token_counts.extend(map(len, tokenize_texts(texts[i : i + batch_size])))
+
+    return token_counts